@@ -1,5 +1,16 @@
 #!/usr/bin/env python3
-import binascii
+"""
+Usage:
+    gpt.py <filename>
+    gpt.py index <directory> [--pattern=pattern] [--csv=filename] [--json=filename] [--workers=number]
+
+Options:
+    --pattern=pattern                  Names of the gpt images to pick up [default: gpt_main*.bin]
+    --csv=filename                     Write the index as csv, one row per partition
+    --json=filename                    Write the index as json, one object per image
+    --workers=number                   Number of parser processes, defaults to the cpu count
+"""
+import zlib
 from Library.utils import *
 
 
@@ -18,7 +29,8 @@ class gpt(metaclass=LogBase):
         ('disk_guid', '16s'),
         ('part_entry_start_lba', 'Q'),
         ('num_part_entries', 'I'),
-        ('part_entry_size', 'I')
+        ('part_entry_size', 'I'),
+        ('crc32_part_entries', 'I')
     ]
 
     gpt_partition = [
@@ -29,6 +41,13 @@ class gpt(metaclass=LogBase):
         ('flags', '>Q'),
         ('name', '72s')]
 
+    # gpt_partition as one precompiled struct, the big-endian flags are taken as raw bytes
+    gpt_partition_struct = struct.Struct("<16s16sQQ8s72s")
+    guid_struct = struct.Struct("<IHHH6s")
+
+    class partf:
+        __slots__ = ("unique", "first_lba", "last_lba", "flags", "sector", "sectors", "type", "name")
+
     class efi_type(Enum):
         EFI_UNUSED = 0x00000000
         EFI_MBR = 0x024DEE41
@@ -116,6 +135,8 @@ class gpt(metaclass=LogBase):
         EFI_VMWARE_VMFS = 0xAA31E02A
         EFI_VMWARE_RESERVED = 0x9198EFFC
 
+    efi_type_names = {member.value: member.name for member in efi_type}
+
     def __init__(self, num_part_entries=0, part_entry_size=0, part_entry_start_lba=0, loglevel=logging.INFO,*args, **kwargs):
         self.num_part_entries = num_part_entries
         self.part_entry_size = part_entry_size
@@ -132,11 +153,26 @@ class gpt(metaclass=LogBase):
             fh = logging.FileHandler(logfilename)
             self.__logger.addHandler(fh)
 
-    def parseheader(self, gptdata, sectorsize=512):
-        return read_object(gptdata[sectorsize:sectorsize + 0x5C], self.gpt_header)
+    def parseheader(self, gptdata, sectorsize=512, headerlba=1, baselba=0):
+        # gptdata starts at sector baselba, the header sits at headerlba
+        offset = (headerlba - baselba) * sectorsize
+        return read_object(gptdata[offset:offset + 0x5C], self.gpt_header)
+
+    def check_header_crc(self, gptdata, sectorsize=512, headerlba=1, baselba=0):
+        # crc32 over header_size bytes with the crc field taken as zero
+        offset = (headerlba - baselba) * sectorsize
+        header = self.parseheader(gptdata, sectorsize, headerlba, baselba)
+        size = header["header_size"]
+        if header["signature"] != b"EFI PART" or size < 0x5C or size > sectorsize:
+            return False
+        view = memoryview(gptdata)
+        crc = zlib.crc32(view[offset:offset + 16])
+        crc = zlib.crc32(b"\x00\x00\x00\x00", crc)
+        crc = zlib.crc32(view[offset + 20:offset + size], crc)
+        return crc == header["crc32"]
 
-    def parse(self, gptdata, sectorsize=512):
-        self.header = read_object(gptdata[sectorsize:sectorsize + 0x5C], self.gpt_header)
+    def parse(self, gptdata, sectorsize=512, headerlba=1, baselba=0):
+        self.header = self.parseheader(gptdata, sectorsize, headerlba, baselba)
         self.sectorsize = sectorsize
         if self.header["signature"] != b"EFI PART":
             self.__logger.error("Invalid or unknown GPT magic.")
@@ -144,56 +180,59 @@ class gpt(metaclass=LogBase):
         if self.header["revision"] != 0x100:
             self.__logger.error("Unknown GPT revision.")
             return False
+        if not self.check_header_crc(gptdata, sectorsize, headerlba, baselba):
+            self.__logger.error("GPT header crc mismatch.")
+            return False
         if self.part_entry_start_lba != 0:
             start = self.part_entry_start_lba
         else:
-            start = self.header["part_entry_start_lba"] * sectorsize
+            start = (self.header["part_entry_start_lba"] - baselba) * sectorsize
         if "part_entry_size" in self.header:
             entrysize = self.header["part_entry_size"]
         else:
             entrysize = self.part_entry_size
         self.partentries = []
 
-        class partf:
-            unique = b""
-            first_lba = 0
-            last_lba = 0
-            flags = 0
-            sector = 0
-            sectors = 0
-            type = b""
-            name = ""
-
         if "num_part_entries" in self.header:
             num_part_entries = self.header["num_part_entries"]
         else:
             num_part_entries = self.num_part_entries
 
-        for idx in range(0, num_part_entries):
-            data = gptdata[start + (idx * entrysize):start + (idx * entrysize) + entrysize]
-            if int(hexlify(data[0:16]), 16) == 0:
+        view = memoryview(gptdata)
+        # The entry crc covers the array the header describes, an overridden start can't be checked
+        if self.part_entry_start_lba == 0:
+            entries = view[start:start + num_part_entries * entrysize]
+            if start < 0 or len(entries) != num_part_entries * entrysize or \
+                    zlib.crc32(entries) != self.header["crc32_part_entries"]:
+                self.__logger.error("GPT partition entries crc mismatch.")
+                return False
+        entrystruct = self.gpt_partition_struct
+        num_part_entries = max(0, min(num_part_entries, (len(view) - start) // entrysize))
+        if entrysize == entrystruct.size:
+            entries = entrystruct.iter_unpack(view[start:start + num_part_entries * entrysize])
+        else:
+            entries = (entrystruct.unpack_from(view, start + idx * entrysize) for idx in range(num_part_entries))
+        empty = bytes(16)
+        typenames = self.efi_type_names
+        guid = self.guid_struct.unpack
+        for ptype, unique, first_lba, last_lba, flags, name in entries:
+            if ptype == empty:
                 break
-            partentry = read_object(data, self.gpt_partition)
-            pa = partf()
-            guid1 = struct.unpack("<I", partentry["unique"][0:0x4])[0]
-            guid2 = struct.unpack("<H", partentry["unique"][0x4:0x6])[0]
-            guid3 = struct.unpack("<H", partentry["unique"][0x6:0x8])[0]
-            guid4 = struct.unpack("<H", partentry["unique"][0x8:0xA])[0]
-            guid5 = binascii.hexlify(partentry["unique"][0xA:0x10]).decode('utf-8')
-            pa.unique = "{:08x}-{:04x}-{:04x}-{:04x}-{}".format(guid1, guid2, guid3, guid4, guid5)
-            pa.sector = partentry["first_lba"]
-            pa.sectors = partentry["last_lba"] - partentry["first_lba"] + 1
-            pa.flags = partentry["flags"]
-            type = int(struct.unpack("<I", partentry["type"][0:0x4])[0])
-            try:
-                pa.type = self.efi_type(type).name
-            except:
-                pa.type = hex(type)
-            pa.name = partentry["name"].replace(b"\x00\x00", b"").decode('utf-16')
-            if pa.type == "EFI_UNUSED":
+            type = int.from_bytes(ptype[:4], "little")
+            if type == 0:  # EFI_UNUSED
                 break
+            pa = self.partf()
+            guid1, guid2, guid3, guid4, guid5 = guid(unique)
+            pa.unique = "{:08x}-{:04x}-{:04x}-{:04x}-{}".format(guid1, guid2, guid3, guid4, guid5.hex())
+            pa.first_lba = first_lba
+            pa.last_lba = last_lba
+            pa.sector = first_lba
+            pa.sectors = last_lba - first_lba + 1
+            pa.flags = int.from_bytes(flags, "big")
+            pa.type = typenames.get(type, hex(type))
+            pa.name = name.replace(b"\x00\x00", b"").decode('utf-16')
             self.partentries.append(pa)
-            self.totalsectors = self.header["last_usable_lba"]
+        self.totalsectors = self.header["last_usable_lba"]
         return True
 
     def print(self):
@@ -241,8 +280,11 @@ class gpt(metaclass=LogBase):
 
     def print_gptfile(self,filename):
         with open(filename, "rb") as rf:
-            sectorsize = 4096
-            result=self.parse(rf.read(), sectorsize)
+            data = rf.read()
+            sectorsize = detect_sectorsize(data)
+            if sectorsize is None:
+                sectorsize = 4096
+            result=self.parse(data, sectorsize)
             if result:
                 print(self.tostring())
             return result
@@ -252,9 +294,88 @@ class gpt(metaclass=LogBase):
         res=self.print_gptfile(os.path.join("TestFiles", "gpt_sm8180x.bin"))
         assert res,"GPT Partition wasn't decoded properly"
 
+
+def detect_sectorsize(data):
+    # The header follows the protective mbr, so its offset is the sector size
+    for sectorsize in [512, 4096]:
+        if data[sectorsize:sectorsize + 8] == b"EFI PART":
+            return sectorsize
+    return None
+
+
+def analyze_gptfile(filename):
+    # Index entry for one gpt image, runs in the worker processes
+    result = {"file": filename, "sectorsize": None, "partitions": [], "error": None}
+    try:
+        with open(filename, "rb") as rf:
+            data = rf.read()
+    except OSError as e:
+        result["error"] = str(e)
+        return result
+    sectorsize = detect_sectorsize(data)
+    if sectorsize is None:
+        result["error"] = "no gpt header found"
+        return result
+    result["sectorsize"] = sectorsize
+    guid_gpt = gpt(loglevel=logging.CRITICAL)
+    try:
+        if not guid_gpt.parse(data, sectorsize):
+            result["error"] = "invalid gpt"
+            return result
+    except struct.error:
+        result["error"] = "truncated gpt"
+        return result
+    for partition in guid_gpt.partentries:
+        result["partitions"].append({"name": partition.name, "sector": partition.sector,
+                                     "sectors": partition.sectors, "type": partition.type,
+                                     "unique": partition.unique, "flags": partition.flags})
+    return result
+
+
+def build_index(directory, pattern="gpt_main*.bin", workers=None):
+    # Walks directory for gpt images and parses them in a process pool
+    from concurrent.futures import ProcessPoolExecutor
+    from fnmatch import fnmatch
+    filenames = []
+    for root, dirs, files in os.walk(directory):
+        for filename in sorted(files):
+            if fnmatch(filename, pattern):
+                filenames.append(os.path.join(root, filename))
+    filenames.sort()
+    with ProcessPoolExecutor(workers) as pool:
+        return list(pool.map(analyze_gptfile, filenames, chunksize=16))
+
+
+def write_index_csv(results, filename):
+    import csv
+    with open(filename, "w", newline="") as wf:
+        writer = csv.writer(wf)
+        writer.writerow(["file", "sectorsize", "name", "sector", "sectors", "type", "unique", "flags", "error"])
+        for result in results:
+            if result["error"] is not None:
+                writer.writerow([result["file"], result["sectorsize"], "", "", "", "", "", "", result["error"]])
+            for partition in result["partitions"]:
+                writer.writerow([result["file"], result["sectorsize"], partition["name"], partition["sector"],
+                                 partition["sectors"], partition["type"], partition["unique"],
+                                 hex(partition["flags"]), ""])
+
+
 if __name__=="__main__":
-    if len(sys.argv)<2:
-        print("Usage: ./gpt.py <filename>")
-        sys.exit()
-    gp = gpt()
-    gp.print_gptfile(sys.argv[1])
+    from docopt import docopt
+    import json
+    args = docopt(__doc__, version='GPT 1.0')
+    if args["index"]:
+        workers = int(args["--workers"]) if args["--workers"] else None
+        results = build_index(args["<directory>"], args["--pattern"], workers)
+        if args["--csv"]:
+            write_index_csv(results, args["--csv"])
+        if args["--json"]:
+            with open(args["--json"], "w") as wf:
+                json.dump(results, wf, indent=4)
+        failed = [result for result in results if result["error"] is not None]
+        print(f"Indexed {len(results) - len(failed)} gpt images, {len(failed)} failed.")
+        for result in failed:
+            print(f"{result['file']}: {result['error']}")
+    else:
+        gp = gpt()
+        gp.print_gptfile(args["<filename>"])
@@ -0,0 +1,429 @@
+#!/usr/bin/env python3
+# Output sinks for Mtk.readflash, write() gets a memoryview that is only valid during the call
+import gzip
+import hashlib
+import lzma
+import os
+import queue
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from struct import pack
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+class base_sink:
+    def write(self, data):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class file_sink(base_sink):
+    def __init__(self, filename, mode="wb"):
+        self.filename = filename
+        self.wf = open(filename, mode)
+        self.start = self.wf.tell()
+
+    def write(self, data):
+        self.wf.write(data)
+
+    def patch(self, offset, data):
+        # offset is relative to where the sink started writing
+        pos = self.wf.tell()
+        self.wf.seek(self.start + offset)
+        self.wf.write(data)
+        self.wf.seek(pos)
+
+    def close(self):
+        if self.wf is not None:
+            self.wf.close()
+            self.wf = None
+
+
+class buffer_sink(base_sink):
+    # Collects the stream into a bytearray preallocated to the expected length
+
+    def __init__(self, length):
+        self.buffer = bytearray(length)
+        self.view = memoryview(self.buffer)
+        self.pos = 0
+
+    def write(self, data):
+        size = len(data)
+        self.view[self.pos:self.pos + size] = data
+        self.pos += size
+
+    def patch(self, offset, data):
+        self.view[offset:offset + len(data)] = data
+
+    def getvalue(self):
+        if self.pos != len(self.buffer):
+            del self.view
+            del self.buffer[self.pos:]
+            self.view = memoryview(self.buffer)
+        return self.buffer
+
+
+class callback_sink(base_sink):
+    def __init__(self, callback):
+        self.callback = callback
+
+    def write(self, data):
+        self.callback(data)
+
+
+class tee_sink(base_sink):
+    def __init__(self, *sinks):
+        self.sinks = sinks
+
+    def write(self, data):
+        for sink in self.sinks:
+            sink.write(data)
+
+    def close(self):
+        for sink in self.sinks:
+            sink.close()
+
+
+class block_sink(base_sink):
+    # Writes from offset and reports each blocksize block as callback(offset, length, sha256), patch() re-reports
+
+    def __init__(self, wf, offset, length, blocksize, callback):
+        self.wf = wf
+        self.wf.seek(offset)
+        self.start = offset
+        self.end = offset + length
+        self.blocksize = blocksize
+        self.callback = callback
+        self.blockstart = offset
+        self.pos = offset
+        self.hash = hashlib.sha256()
+
+    def write(self, data):
+        size = len(data)
+        start = 0
+        while start < size and self.pos < self.end:
+            blockend = min(self.blockstart + self.blocksize, self.end)
+            count = min(blockend - self.pos, size - start)
+            chunk = data[start:start + count]
+            self.wf.write(chunk)
+            self.hash.update(chunk)
+            self.pos += count
+            start += count
+            if self.pos == blockend:
+                self.wf.flush()
+                self.callback(self.blockstart, blockend - self.blockstart, self.hash.hexdigest())
+                self.blockstart = blockend
+                self.hash = hashlib.sha256()
+
+    def patch(self, offset, data):
+        # offset is relative to where the sink started writing
+        start = self.start + offset
+        self.wf.seek(start)
+        self.wf.write(data)
+        first = self.start + (offset // self.blocksize) * self.blocksize
+        for blockstart in range(first, min(start + len(data), self.pos), self.blocksize):
+            blockend = min(blockstart + self.blocksize, self.end, self.pos)
+            self.wf.seek(blockstart)
+            digest = hashlib.sha256(self.wf.read(blockend - blockstart))
+            if blockstart == self.blockstart:
+                # The block still being written keeps hashing from here
+                self.hash = digest
+            else:
+                self.callback(blockstart, blockend - blockstart, digest.hexdigest())
+        self.wf.seek(self.pos)
+
+
+class hash_sink(base_sink):
+    # Passes the stream on to sink while hashing it with the given hashlib algorithms
+
+    def __init__(self, sink, algorithms=("sha256",)):
+        self.sink = sink
+        self.filename = getattr(sink, "filename", None)
+        self.hashes = [(name, hashlib.new(name)) for name in algorithms]
+        self.length = 0
+
+    def write(self, data):
+        for name, digest in self.hashes:
+            digest.update(data)
+        self.length += len(data)
+        self.sink.write(data)
+
+    def hexdigests(self):
+        return {name: digest.hexdigest() for name, digest in self.hashes}
+
+    def close(self):
+        self.sink.close()
+
+
+class split_sink(base_sink):
+    # parts are sorted (offset, length, sink) of the stream, bytes outside every part are dropped
+
+    def __init__(self, parts):
+        self.parts = parts
+        self.index = 0
+        self.pos = 0
+
+    def write(self, data):
+        size = len(data)
+        start = 0
+        while start < size and self.index < len(self.parts):
+            offset, length, sink = self.parts[self.index]
+            pos = self.pos + start
+            if pos < offset:
+                start += min(offset - pos, size - start)
+                continue
+            count = min(offset + length - pos, size - start)
+            if count > 0:
+                sink.write(data[start:start + count])
+                start += count
+            if pos + count >= offset + length:
+                self.index += 1
+        self.pos += size
+
+    def close(self):
+        for offset, length, sink in self.parts:
+            sink.close()
+
+
+class threaded_sink(base_sink):
+    # Copies each write to a bounded queue, a writer thread passes it on to sink
+
+    def __init__(self, sink, depth=8):
+        self.sink = sink
+        self.queue = queue.Queue(depth)
+        self.error = None
+        self.thread = threading.Thread(target=self.writer, daemon=True)
+        self.thread.start()
+
+    def writer(self):
+        while True:
+            data = self.queue.get()
+            if data is None:
+                break
+            # Keep draining after an error so write() never blocks on a full queue
+            if self.error is None:
+                try:
+                    self.sink.write(data)
+                except Exception as e:
+                    self.error = e
+
+    def write(self, data):
+        if self.error is not None:
+            raise self.error
+        self.queue.put(bytes(data))
+
+    def close(self):
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+            self.sink.close()
+        if self.error is not None:
+            raise self.error
+
+
+class block_scan_sink(base_sink):
+    # Passes runs of whole blocks to run(fill, view), fill is the byte of an all-fill block or None for data
+    fills = (0x00, 0xFF)
+
+    def __init__(self, blocksize):
+        self.blocksize = blocksize
+        self.patterns = [(fill, bytes([fill]) * blocksize) for fill in self.fills]
+        self.pending = bytearray()
+
+    def write(self, data):
+        self.pending += data
+        end = len(self.pending) - len(self.pending) % self.blocksize
+        if end > 0:
+            self.scan(end)
+            del self.pending[:end]
+
+    def scan(self, end):
+        pending = self.pending
+        with memoryview(pending) as view:
+            start = 0
+            kind = None
+            for pos in range(0, end, self.blocksize):
+                # startswith compares in C, no copy of the block is made
+                blockkind = None
+                for fill, pattern in self.patterns:
+                    if pending.startswith(pattern, pos):
+                        blockkind = fill
+                        break
+                if blockkind != kind and pos > start:
+                    self.run(kind, view[start:pos])
+                    start = pos
+                kind = blockkind
+            self.run(kind, view[start:end])
+
+    def run(self, fill, data):
+        raise NotImplementedError
+
+    def close(self):
+        if len(self.pending) > 0:
+            self.run(None, self.pending)
+            self.pending = bytearray()
+
+
+class hole_sink(block_scan_sink):
+    # Plain image that seeks over zero blocks, leaving holes where the filesystem supports them
+    fills = (0x00,)
+
+    def __init__(self, filename, blocksize=4096):
+        super().__init__(blocksize)
+        self.filename = filename
+        self.wf = open(filename, "wb")
+
+    def run(self, fill, data):
+        if fill is None:
+            self.wf.write(data)
+        else:
+            self.wf.seek(len(data), 1)
+
+    def close(self):
+        if self.wf is not None:
+            super().close()
+            # Extends the file over a trailing hole
+            self.wf.truncate()
+            self.wf.close()
+            self.wf = None
+
+
+class android_sparse_sink(block_scan_sink):
+    # Android sparse image, 0x00 and 0xFF blocks become FILL chunks and a partial last block is zero padded
+    SPARSE_HEADER_MAGIC = 0xED26FF3A
+    CHUNK_TYPE_RAW = 0xCAC1
+    CHUNK_TYPE_FILL = 0xCAC2
+    FILE_HEADER_SIZE = 28
+    CHUNK_HEADER_SIZE = 12
+    # total_sz of a chunk is a uint32
+    MAX_CHUNK_SIZE = 0xFFFFFFFF
+
+    def __init__(self, filename, blocksize=4096):
+        super().__init__(blocksize)
+        self.maxchunkblocks = (self.MAX_CHUNK_SIZE - self.CHUNK_HEADER_SIZE) // blocksize
+        self.filename = filename
+        self.wf = open(filename, "wb")
+        self.wf.write(bytes(self.FILE_HEADER_SIZE))
+        self.totalblocks = 0
+        self.totalchunks = 0
+        self.kind = None
+        self.chunkstart = 0
+        self.chunkblocks = 0
+
+    def run(self, fill, data):
+        if len(data) % self.blocksize != 0:
+            data = bytes(data) + bytes(self.blocksize - len(data) % self.blocksize)
+        with memoryview(data) as view:
+            blocks = len(view) // self.blocksize
+            pos = 0
+            while pos < blocks:
+                if fill != self.kind or self.chunkblocks == 0 or self.chunkblocks == self.maxchunkblocks:
+                    self.end_chunk()
+                    self.kind = fill
+                    self.chunkstart = self.wf.tell()
+                    if fill is None:
+                        # Header is filled in once the length of the raw run is known
+                        self.wf.write(bytes(self.CHUNK_HEADER_SIZE))
+                count = min(blocks - pos, self.maxchunkblocks - self.chunkblocks)
+                if fill is None:
+                    self.wf.write(view[pos * self.blocksize:(pos + count) * self.blocksize])
+                self.chunkblocks += count
+                pos += count
+
+    def end_chunk(self):
+        if self.chunkblocks == 0:
+            return
+        if self.kind is None:
+            pos = self.wf.tell()
+            self.wf.seek(self.chunkstart)
+            self.wf.write(pack("<HHII", self.CHUNK_TYPE_RAW, 0, self.chunkblocks,
+                               self.CHUNK_HEADER_SIZE + self.chunkblocks * self.blocksize))
+            self.wf.seek(pos)
+        else:
+            self.wf.write(pack("<HHIII", self.CHUNK_TYPE_FILL, 0, self.chunkblocks, self.CHUNK_HEADER_SIZE + 4,
+                               self.kind * 0x01010101))
+        self.totalblocks += self.chunkblocks
+        self.totalchunks += 1
+        self.chunkblocks = 0
+
+    def close(self):
+        if self.wf is not None:
+            super().close()
+            self.end_chunk()
+            self.wf.seek(0)
+            self.wf.write(pack("<IHHHHIIII", self.SPARSE_HEADER_MAGIC, 1, 0, self.FILE_HEADER_SIZE,
+                               self.CHUNK_HEADER_SIZE, self.blocksize, self.totalblocks, self.totalchunks, 0))
+            self.wf.close()
+            self.wf = None
+
+
+class compress_sink(base_sink):
+    # Compresses blocks on a thread pool into concatenated gzip members, xz streams or zstd frames
+    extensions = {"gzip": ".gz", "xz": ".xz", "zstd": ".zst"}
+
+    @staticmethod
+    def available(method):
+        return method != "zstd" or zstandard is not None
+
+    def __init__(self, filename, method="gzip", blocksize=0x400000, workers=None, pool=None):
+        if method == "gzip":
+            self.compress = lambda data: gzip.compress(data, 6)
+        elif method == "xz":
+            self.compress = lzma.compress
+        elif method == "zstd":
+            if zstandard is None:
+                raise RuntimeError("zstd compression needs the zstandard module")
+            # A compressor object must not be shared between threads
+            self.compress = lambda data: zstandard.ZstdCompressor().compress(data)
+        else:
+            raise ValueError("Unknown compression method " + method)
+        if workers is None:
+            workers = os.cpu_count() or 1
+        self.filename = filename
+        self.wf = open(filename, "wb")
+        self.blocksize = blocksize
+        self.pending = bytearray()
+        # Sinks that are open at the same time can share one pool, it is left running on close
+        self.ownpool = pool is None
+        self.pool = ThreadPoolExecutor(workers) if pool is None else pool
+        self.inflight = deque()
+        self.depth = 2 * workers
+        self.blocks = 0
+
+    def write(self, data):
+        self.pending += data
+        while len(self.pending) >= self.blocksize:
+            self.submit(bytes(self.pending[:self.blocksize]))
+            del self.pending[:self.blocksize]
+
+    def submit(self, block):
+        if len(self.inflight) >= self.depth:
+            self.wf.write(self.inflight.popleft().result())
+        self.inflight.append(self.pool.submit(self.compress, block))
+        self.blocks += 1
+
+    def close(self):
+        if self.wf is not None:
+            if len(self.pending) > 0 or self.blocks == 0:
+                self.submit(bytes(self.pending))
+                self.pending = bytearray()
+            while len(self.inflight) > 0:
+                self.wf.write(self.inflight.popleft().result())
+            if self.ownpool:
+                self.pool.shutdown()
+            self.wf.close()
+            self.wf = None
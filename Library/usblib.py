@@ -4,7 +4,13 @@ from enum import Enum
 import usb.core  # pyusb
 import usb.util
 import time
+import array
+import ctypes
 import inspect
+import atexit
+import select
+import socket
+from collections import deque
 from Library.utils import *
 
 USB_DIR_OUT = 0  # to device
@@ -42,6 +48,100 @@ CDC_CMDS = {
 }
 
 
+class usb_trace:
+    # Ring buffer of (timestamp, direction, length, payload) and optional pcap, the first pcap byte is the direction
+    LINKTYPE_USER0 = 147
+
+    def __init__(self, filename=None, snaplen=64, entries=4096):
+        self.snaplen = snaplen
+        self.ring = deque(maxlen=entries)
+        self.wf = None
+        if filename is not None:
+            self.wf = open(filename, "wb")
+            self.wf.write(struct.pack("<IHHiIII", 0xA1B2C3D4, 2, 4, 0, 0, snaplen + 1, self.LINKTYPE_USER0))
+            atexit.register(self.close)
+
+    def record(self, direction, data):
+        timestamp = time.time()
+        length = len(data)
+        payload = bytes(data[:self.snaplen])
+        self.ring.append((timestamp, direction, length, payload))
+        if self.wf is not None:
+            sec = int(timestamp)
+            self.wf.write(struct.pack("<IIIIB", sec, int((timestamp - sec) * 1000000), len(payload) + 1,
+                                      length + 1, direction))
+            self.wf.write(payload)
+
+    def entries(self):
+        return list(self.ring)
+
+    def close(self):
+        if self.wf is not None:
+            self.wf.close()
+            self.wf = None
+
+
+class usb_hotplug(metaclass=LogBase):
+    # Reports usb devices added, from kernel uevents on a netlink socket; open() is False where there is none
+    NETLINK_KOBJECT_UEVENT = 15
+
+    def __init__(self):
+        self.sock = None
+
+    def open(self):
+        if not hasattr(socket, "AF_NETLINK"):
+            return False
+        try:
+            self.sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, self.NETLINK_KOBJECT_UEVENT)
+            # group 1 carries the kernel's own events
+            self.sock.bind((0, 1))
+        except OSError as e:
+            self.__logger.debug("No uevent socket: " + str(e))
+            self.close()
+            return False
+        return True
+
+    def wait(self, timeout):
+        # [(vid, pid)] of the devices added within timeout seconds, [] on timeout
+        added = []
+        deadline = time.time() + timeout
+        while len(added) == 0:
+            remaining = deadline - time.time()
+            if remaining <= 0 or not select.select([self.sock], [], [], remaining)[0]:
+                break
+            try:
+                message = self.sock.recv(0x2000)
+            except OSError:
+                break
+            fields = message.split(b"\x00")
+            if not fields[0].startswith(b"add@"):
+                continue
+            env = dict(field.split(b"=", 1) for field in fields[1:] if b"=" in field)
+            if env.get(b"SUBSYSTEM") != b"usb" or env.get(b"DEVTYPE") != b"usb_device":
+                continue
+            # PRODUCT=vid/pid/bcdDevice in hex
+            product = env.get(b"PRODUCT", b"").split(b"/")
+            if len(product) == 3:
+                added.append((int(product[0], 16), int(product[1], 16)))
+        return added
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+
+class usb_buffer:
+    # Wraps a writable buffer for the pyusb backends, which only need buffer_info()
+    itemsize = 1
+
+    def __init__(self, view):
+        self.cbuffer = (ctypes.c_char * len(view)).from_buffer(view)
+
+    def buffer_info(self):
+        return ctypes.addressof(self.cbuffer), len(self.cbuffer)
+
+
 class usb_class(metaclass=LogBase):
 
     def __init__(self, loglevel=logging.INFO, portconfig=None, devclass=-1):
@@ -51,6 +151,14 @@ class usb_class(metaclass=LogBase):
         self.timeout = None
         self.vid = None
         self.pid = None
+        self.max_transfer_size = 0x100000
+        self.async_depth = 0
+        self.async_size = 0x10000
+        self.async_reader = None
+        self.maxpacketsize_out = 512
+        self.maxpacketsize_in = 512
+        self.trace = None
+        self.debug = loglevel == logging.DEBUG
         self.__logger.setLevel(loglevel)
         if loglevel==logging.DEBUG:
             logfilename = "log.txt"
@@ -58,7 +166,6 @@ class usb_class(metaclass=LogBase):
             self.__logger.addHandler(fh)
 
     def verify_data(self, data, pre="RX:"):
-        self.__logger.debug("",stack_info=True)
         if isinstance(data, bytes) or isinstance(data, bytearray):
             if data[:5] == b"<?xml":
                 try:
@@ -213,6 +320,8 @@ class usb_class(metaclass=LogBase):
                                                                usb.util.ENDPOINT_OUT)
             else:
                 self.EP_OUT = EP_OUT
+            if not isinstance(self.EP_OUT, int):
+                self.maxpacketsize_out = self.EP_OUT.wMaxPacketSize
             if EP_IN == -1:
                 self.EP_IN = usb.util.find_descriptor(itf,
                                                       # match the first OUT endpoint
@@ -222,16 +331,49 @@ class usb_class(metaclass=LogBase):
                                                               usb.util.ENDPOINT_IN)
             else:
                 self.EP_IN = EP_IN
+            if not isinstance(self.EP_IN, int):
+                self.maxpacketsize_in = self.EP_IN.wMaxPacketSize
 
             self.connected = True
+            if self.async_depth > 0:
+                self.async_reader = usb_async_reader.create(self, self.async_depth, self.async_size)
             return True
         else:
             print("Couldn't find MassStorage interface. Aborting.")
             self.connected = False
             return False
 
+    def wait_connect(self, timeout=None, interval=0.3, idle=None):
+        # Connects on the hotplug event, or by polling every interval seconds; idle() runs after each idle interval
+        deadline = None if timeout is None else time.time() + timeout
+        hotplug = usb_hotplug()
+        ids = [(usbid[0], usbid[1]) for usbid in self.portconfig]
+        try:
+            # Listen before the first try, so a device appearing in between isn't missed
+            listening = hotplug.open()
+            while not self.connect():
+                if deadline is not None and time.time() >= deadline:
+                    return False
+                if not listening:
+                    time.sleep(interval)
+                elif any(dev in ids for dev in hotplug.wait(interval)):
+                    # The device node may still be settling, retry for a moment
+                    for attempt in range(20):
+                        if self.connect():
+                            return True
+                        time.sleep(0.01)
+                    continue
+                if idle is not None:
+                    idle()
+            return True
+        finally:
+            hotplug.close()
+
     def close(self,reset=False):
         if self.connected:
+            if self.async_reader is not None:
+                self.async_reader.close()
+                self.async_reader = None
             usb.util.dispose_resources(self.device)
             try:
                 if not self.device.is_kernel_driver_active(self.interface):
@@ -241,11 +383,14 @@ class usb_class(metaclass=LogBase):
             except:
                 pass
 
-    def write(self, command, pktsize=64):
+    def write(self, command, pktsize=None):
+        # One bulk OUT transfer per pktsize (default max_transfer_size) slice of command, empty sends a zero length packet
         if isinstance(command, str):
             command = bytes(command, 'utf-8')
+        if pktsize is None:
+            pktsize = self.max_transfer_size
         pos = 0
-        if command == b'':
+        if len(command) == 0:
             try:
                 self.device.write(self.EP_OUT, b'')
             except usb.core.USBError as e:
@@ -258,11 +403,19 @@ class usb_class(metaclass=LogBase):
                         return False
                 return True
         else:
+            view = memoryview(command).cast('B')
+            length = len(view)
             i = 0
-            while pos < len(command):
+            while pos < length:
+                if pos == 0 and length <= pktsize and isinstance(command, (bytes, bytearray, array.array)):
+                    chunk = command
+                else:
+                    # pyusb copies anything but array.array, so fill one directly from the view
+                    chunk = array.array('B')
+                    chunk.frombytes(view[pos:pos + pktsize])
                 try:
-                    self.device.write(self.EP_OUT, command[pos:pos + pktsize])
-                    pos += pktsize
+                    self.device.write(self.EP_OUT, chunk)
+                    pos += len(chunk)
                 except:
                     # print("Error while writing")
                     time.sleep(0.01)
@@ -270,15 +423,19 @@ class usb_class(metaclass=LogBase):
                     if i == 3:
                         return False
                     pass
-        self.verify_data(bytearray(command), "TX:")
+        if self.trace is not None:
+            self.trace.record(USB_DIR_OUT, command)
+        if self.debug:
+            self.verify_data(bytearray(command), "TX:")
         return True
 
     def read(self, length=0x80, timeout=None):
         tmp = b''
-        self.__logger.debug(inspect.currentframe().f_back.f_code.co_name + ":" + hex(length))
+        if self.debug:
+            self.__logger.debug(inspect.currentframe().f_back.f_code.co_name + ":" + hex(length))
         if timeout is None:
             timeout = self.timeout
-        while bytearray(tmp) == b'':
+        while len(tmp) == 0:
             try:
                 tmp = self.device.read(self.EP_IN, length, timeout)
             except usb.core.USBError as e:
@@ -287,8 +444,8 @@ class usb_class(metaclass=LogBase):
                     # if platform.system()=='Windows':
                     # time.sleep(0.05)
                     # print("Waiting...")
-                    self.__logger.debug("Timed out")
-                    self.__logger.debug(tmp)
+                    if self.debug:
+                        self.__logger.debug("Timed out")
                     return bytearray(tmp)
                 elif "Overflow" in error:
                     self.__logger.error("USB Overflow")
@@ -298,8 +455,54 @@ class usb_class(metaclass=LogBase):
                     sys.exit(0)
                 else:
                     break
-        self.verify_data(bytearray(tmp), "RX:")
-        return bytearray(tmp)
+        tmp = bytearray(tmp)
+        if self.trace is not None:
+            self.trace.record(USB_DIR_IN, tmp)
+        if self.debug:
+            self.verify_data(tmp, "RX:")
+        return tmp
+
+    def bulkread(self, view, timeout):
+        # pyusb only fills array.array, so the backend is handed the caller's memory directly
+        ctx = self.device._ctx
+        if timeout is None:
+            timeout = self.device.default_timeout
+        endpoint = self.EP_IN if isinstance(self.EP_IN, int) else self.EP_IN.bEndpointAddress
+        try:
+            length = ctx.backend.bulk_read(ctx.managed_open(), endpoint, self.interface, usb_buffer(view), timeout)
+            if self.trace is not None:
+                self.trace.record(USB_DIR_IN, view[:length])
+            return length
+        except usb.core.USBError as e:
+            error = str(e.strerror)
+            if "timed out" in error:
+                if self.debug:
+                    self.__logger.debug("Timed out")
+                return 0
+            elif "Overflow" in error:
+                self.__logger.error("USB Overflow")
+                sys.exit(0)
+            elif e.errno is not None:
+                print(repr(e), type(e), e.errno)
+                sys.exit(0)
+            return 0
+
+    def readinto(self, buffer, timeout=None):
+        # Fills buffer in place with max_transfer_size bulk reads, stops early on a short read or timeout
+        if timeout is None:
+            timeout = self.timeout
+        view = memoryview(buffer).cast('B')
+        length = len(view)
+        if self.async_reader is not None and length > self.async_reader.transfer_size:
+            return self.async_reader.readinto(buffer, timeout)
+        pos = 0
+        while pos < length:
+            size = min(length - pos, self.max_transfer_size)
+            received = self.bulkread(view[pos:pos + size], timeout)
+            pos += received
+            if received < size:
+                break
+        return pos
 
     def ctrl_transfer(self, bmRequestType, bRequest, wValue, wIndex, data_or_wLength):
         ret = self.device.ctrl_transfer(bmRequestType=bmRequestType, bRequest=bRequest, wValue=wValue, wIndex=wIndex,
@@ -307,6 +510,143 @@ class usb_class(metaclass=LogBase):
         return ret[0] | (ret[1] << 8)
 
 
+class usb_async_reader(metaclass=LogBase):
+    # Keeps up to depth libusb async bulk IN transfers in flight, libusb1 backend only
+    LIBUSB_TRANSFER_TYPE_BULK = 2
+    LIBUSB_TRANSFER_COMPLETED = 0
+
+    class timeval(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long),
+                    ('tv_usec', ctypes.c_long)]
+
+    def __init__(self, cdc, backend, depth=8, transfer_size=0x10000):
+        from usb.backend import libusb1
+        self.cdc = cdc
+        self.lib = backend.lib
+        self.ctx = backend.ctx
+        self.depth = depth
+        self.transfer_size = transfer_size
+        self.completed = deque()
+        self.handle = cdc.device._ctx.handle.handle
+        if isinstance(cdc.EP_IN, int):
+            self.endpoint = cdc.EP_IN
+        else:
+            self.endpoint = cdc.EP_IN.bEndpointAddress
+        self.lib.libusb_handle_events_timeout.argtypes = [ctypes.c_void_p, ctypes.POINTER(self.timeval)]
+        self.lib.libusb_cancel_transfer.argtypes = [ctypes.POINTER(libusb1._libusb_transfer)]
+        self.callback = libusb1._libusb_transfer_cb_fn_p(self.transfer_done)
+        self.transfers = []
+        for i in range(depth):
+            transfer = self.lib.libusb_alloc_transfer(0)
+            if not transfer:
+                raise MemoryError("libusb_alloc_transfer failed")
+            self.transfers.append(transfer)
+        self.slots = {ctypes.addressof(transfer.contents): i for i, transfer in enumerate(self.transfers)}
+
+    @classmethod
+    def create(cls, cdc, depth, transfer_size):
+        backend = cdc.device._ctx.backend
+        if type(backend).__module__ != "usb.backend.libusb1":
+            cls.__logger.warning("Async usb transport needs the libusb1 backend, using sync reads.")
+            return None
+        try:
+            cdc.device._ctx.managed_open()
+            return cls(cdc, backend, depth, transfer_size)
+        except Exception as e:
+            cls.__logger.warning("Async usb transport unavailable, using sync reads: " + str(e))
+            return None
+
+    def transfer_done(self, transfer):
+        self.completed.append(self.slots[ctypes.addressof(transfer.contents)])
+
+    def submit(self, slot, address, length, timeout):
+        transfer = self.transfers[slot].contents
+        transfer.dev_handle = self.handle
+        transfer.flags = 0
+        transfer.endpoint = self.endpoint
+        transfer.type = self.LIBUSB_TRANSFER_TYPE_BULK
+        transfer.timeout = timeout
+        transfer.length = length
+        transfer.actual_length = 0
+        transfer.buffer = address
+        transfer.num_iso_packets = 0
+        transfer.callback = self.callback
+        return self.lib.libusb_submit_transfer(self.transfers[slot]) == 0
+
+    def wait(self):
+        tv = self.timeval(0, 100000)
+        while not self.completed:
+            self.lib.libusb_handle_events_timeout(self.ctx, ctypes.byref(tv))
+        return self.completed.popleft()
+
+    def readinto(self, buffer, timeout=None):
+        # Transfers are consumed in submit order, the first short one ends the read
+        if timeout is None:
+            timeout = 1000
+        view = memoryview(buffer).cast('B')
+        length = len(view)
+        if isinstance(buffer, array.array):
+            base = buffer.buffer_info()[0]
+        else:
+            cbuffer = (ctypes.c_char * length).from_buffer(view)
+            base = ctypes.addressof(cbuffer)
+        trace = self.cdc.trace
+        pieces = [(pos, min(self.transfer_size, length - pos)) for pos in range(0, length, self.transfer_size)]
+        inflight = deque()
+        done = set()
+        nextpiece = 0
+        received = 0
+        stopped = False
+        while nextpiece < len(pieces) and len(inflight) < self.depth:
+            pos, size = pieces[nextpiece]
+            if not self.submit(len(inflight), base + pos, size, timeout):
+                stopped = True
+                self.cancel(inflight)
+                break
+            inflight.append((len(inflight), pos, size))
+            nextpiece += 1
+        while inflight:
+            slot, pos, size = inflight[0]
+            while slot not in done:
+                done.add(self.wait())
+            done.discard(slot)
+            inflight.popleft()
+            transfer = self.transfers[slot].contents
+            actual = transfer.actual_length
+            # After a short packet the stream continues in the next transfer, close the gap
+            if actual and pos != received:
+                view[received:received + actual] = bytes(view[pos:pos + actual])
+            if actual and trace is not None:
+                trace.record(USB_DIR_IN, view[received:received + actual])
+            received += actual
+            if stopped:
+                continue
+            if transfer.status != self.LIBUSB_TRANSFER_COMPLETED or actual < size:
+                if transfer.status != self.LIBUSB_TRANSFER_COMPLETED:
+                    self.__logger.debug("Async transfer failed, status " + str(transfer.status))
+                stopped = True
+                self.cancel(inflight)
+                continue
+            if nextpiece < len(pieces):
+                pos, size = pieces[nextpiece]
+                if self.submit(slot, base + pos, size, timeout):
+                    inflight.append((slot, pos, size))
+                    nextpiece += 1
+                else:
+                    stopped = True
+                    self.cancel(inflight)
+        return received
+
+    def cancel(self, inflight):
+        for slot, _, _ in inflight:
+            self.lib.libusb_cancel_transfer(self.transfers[slot])
+
+    def close(self):
+        for transfer in self.transfers:
+            self.lib.libusb_free_transfer(transfer)
+        self.transfers = []
+
+
 class scsi_cmds(Enum):
     SC_TEST_UNIT_READY = 0x00,
     SC_REQUEST_SENSE = 0x03,
@@ -9,6 +9,7 @@ import stat
 import colorama
 import copy
 from binascii import hexlify
+from zlib import adler32
 
 try:
     from capstone import *
@@ -16,6 +17,11 @@ try:
 except:
     print("Capstone and Keystone libraries missing.")
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 def do_tcp_server(client,arguments, handler):
     def tcpprint(arg):
         if isinstance(arg, bytes) or isinstance(arg, bytearray):
@@ -61,6 +67,32 @@ def do_tcp_server(client,arguments, handler):
         finally:
             connection.close()
 
+def checksum16(data):
+    # 16-bit byte sum the DA sends after each read packet
+    if numpy is not None:
+        return int(numpy.frombuffer(data, dtype=numpy.uint8).sum(dtype=numpy.uint64)) & 0xFFFF
+    view = memoryview(data).cast('B')
+    # Over at most 256 bytes the low half of adler32 is 1 + the byte sum, it can't reach the modulus
+    total = 0
+    for pos in range(0, len(view), 256):
+        total += (adler32(view[pos:pos + 256]) & 0xFFFF) - 1
+    return total & 0xFFFF
+
+def xor16(data):
+    # XOR of the little-endian 16-bit words the BROM returns for CMD_SEND_DA, without numpy folded as one big int
+    view = memoryview(data).cast('B')
+    if len(view) % 2:
+        view = bytes(view) + b"\x00"
+    if numpy is not None:
+        return int(numpy.bitwise_xor.reduce(numpy.frombuffer(view, dtype='<u2'), initial=0))
+    value = int.from_bytes(view, 'little')
+    bits = len(view) * 8
+    while bits > 16:
+        half = -(-bits // 32) * 16
+        value = (value & ((1 << half) - 1)) ^ (value >> half)
+        bits = half
+    return value
+
 def getint(valuestr):
     try:
         return int(valuestr)
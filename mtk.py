@@ -10,26 +10,26 @@ Usage:
     mtk.py [--debugmode]
     mtk.py [--gpt-num-part-entries=number] [--gpt-part-entry-size=number] [--gpt-part-entry-start-lba=number]
     mtk.py [--sectorsize=bytes]
-    mtk.py printgpt [--memory=memtype] [--lun=lun] [--loader=filename] [--debugmode] [--vid=vid] [--pid=pid]
-    mtk.py gpt <filename> [--memory=memtype] [--lun=lun] [--genxml] [--loader=filename] [--debugmode] [--vid=vid] [--pid=pid]
-    mtk.py r <partitionname> <filename> [--memory=memtype] [--lun=lun] [--loader=filename] [--debugmode] [--vid=vid] [--pid=pid]
-    mtk.py rl <directory> [--memory=memtype] [--lun=lun] [--skip=partnames] [--genxml] [--loader=filename] [--debugmode] [--vid=vid] [--pid=pid]
-    mtk.py rf <filename> [--memory=memtype] [--lun=lun] [--loader=filename] [--debugmode] [--vid=vid] [--pid=pid]
-    mtk.py rs <start_sector> <sectors> <filename> [--lun=lun] [--loader=filename] [--debugmode] [--vid=vid] [--pid=pid]
-    mtk.py footer <filename> [--memory=memtype] [--lun=lun] [--loader=filename] [--debugmode] [--vid=vid] [--pid=pid]
-    mtk.py reset [--debugmode] [--vid=vid] [--pid=pid]
-    mtk.py dumpbrom [--filename=filename] [--ptype=ptype] [--wdt=wdt] [--var0=var0] [--var1=var1] [--da_addr=addr] [--brom_addr=addr] [--uartaddr=addr] [--debugmode] [--vid=vid] [--pid=pid] [--interface=interface]
-    mtk.py payload <filename> [--var0=var0] [--var1=var1] [--wdt=wdt] [--uartaddr=addr] [--da_addr=addr] [--brom_addr=addr] [--debugmode] [--vid=vid] [--pid=pid] [--interface=interface]
-    mtk.py crash [--debugmode] [--vid=vid] [--pid=pid]
-    mtk.py gettargetconfig [--debugmode] [--vid=vid] [--pid=pid]
+    mtk.py printgpt [--memory=memtype] [--lun=lun] [--loader=filename] [--debugmode] [--usbtrace=filename] [--vid=vid] [--pid=pid]
+    mtk.py gpt <filename> [--memory=memtype] [--lun=lun] [--genxml] [--loader=filename] [--debugmode] [--usbtrace=filename] [--vid=vid] [--pid=pid]
+    mtk.py r <partitionname> <filename> [--memory=memtype] [--lun=lun] [--sparse=mode] [--compress=method] [--loader=filename] [--debugmode] [--usbtrace=filename] [--vid=vid] [--pid=pid] [--async-depth=number] [--async-size=bytes]
+    mtk.py rl <directory> [--memory=memtype] [--lun=lun] [--skip=partnames] [--genxml] [--sparse=mode] [--compress=method] [--hash=algorithms] [--loader=filename] [--debugmode] [--usbtrace=filename] [--vid=vid] [--pid=pid] [--async-depth=number] [--async-size=bytes]
+    mtk.py rf <filename> [--memory=memtype] [--lun=lun] [--resume] [--compress=method] [--loader=filename] [--debugmode] [--usbtrace=filename] [--vid=vid] [--pid=pid] [--async-depth=number] [--async-size=bytes]
+    mtk.py rs <start_sector> <sectors> <filename> [--lun=lun] [--resume] [--loader=filename] [--debugmode] [--usbtrace=filename] [--vid=vid] [--pid=pid] [--async-depth=number] [--async-size=bytes]
+    mtk.py footer <filename> [--memory=memtype] [--lun=lun] [--loader=filename] [--debugmode] [--usbtrace=filename] [--vid=vid] [--pid=pid]
+    mtk.py reset [--debugmode] [--usbtrace=filename] [--vid=vid] [--pid=pid]
+    mtk.py dumpbrom [--filename=filename] [--ptype=ptype] [--wdt=wdt] [--var0=var0] [--var1=var1] [--da_addr=addr] [--brom_addr=addr] [--uartaddr=addr] [--debugmode] [--usbtrace=filename] [--vid=vid] [--pid=pid] [--interface=interface] [--async-depth=number] [--async-size=bytes]
+    mtk.py payload <filename> [--var0=var0] [--var1=var1] [--wdt=wdt] [--uartaddr=addr] [--da_addr=addr] [--brom_addr=addr] [--debugmode] [--usbtrace=filename] [--vid=vid] [--pid=pid] [--interface=interface]
+    mtk.py crash [--debugmode] [--usbtrace=filename] [--vid=vid] [--pid=pid]
+    mtk.py gettargetconfig [--debugmode] [--usbtrace=filename] [--vid=vid] [--pid=pid]
 
 Description:
     printgpt [--memory=memtype] [--lun=lun]                                      # Print GPT Table information
     gpt <directory> [--memory=memtype] [--lun=lun]                               # Save gpt table to given directory
     r <partitionname> <filename> [--memory=memtype] [--lun=lun]                  # Read flash to filename
     rl <directory> [--memory=memtype] [--lun=lun] [--skip=partname]              # Read all partitions from flash to a directory
-    rf <filename> [--memory=memtype] [--lun=lun]                                 # Read whole flash to file
-    rs <start_sector> <sectors> <filename> [--lun=lun]                           # Read sectors starting at start_sector to filename
+    rf <filename> [--memory=memtype] [--lun=lun] [--resume]                      # Read whole flash to file
+    rs <start_sector> <sectors> <filename> [--lun=lun] [--resume]                # Read sectors starting at start_sector to filename
     footer <filename> [--memory=memtype] [--lun=lun]                             # Read crypto footer from flash
     reset                                                                        # Send mtk reset command
     dumpbrom [--wdt=wdt] [--var0=var0] [--val_1=val_1] [--payload_addr=addr]   # Try to dump the bootrom
@@ -56,6 +56,13 @@ Options:
     --brom_addr=addr                   Set a specific brom payload addr
     --ptype=ptype                      Set the payload type ("amonet","kamakiri")
     --uartaddr=addr                    Set the payload uart addr
+    --async-depth=number               Keep number bulk reads in flight using the libusb async api
+    --async-size=bytes                 Set the size of each queued async bulk read [default: 0x10000]
+    --usbtrace=filename                Capture usb traffic to a pcap file
+    --resume                           Continue an interrupted rf/rs dump using its .manifest.json
+    --sparse=mode                      Write r/rl dumps as "android" sparse images or with "holes" for zero blocks
+    --compress=method                  Compress r/rl/rf dumps while reading ("gzip","xz","zstd")
+    --hash=algorithms                  Hashes for the rl manifest.json, e.g. "sha256,sha1,md5" [default: sha256]
 """
 
 from docopt import docopt
@@ -71,12 +78,19 @@ def getint(value):
 from enum import Enum
 import usb.core
 from Library.utils import *
-from Library.usblib import usb_class
+from Library.usblib import usb_class, usb_trace
 from Library.gpt import gpt
+from Library.sinks import file_sink, buffer_sink, split_sink, threaded_sink, block_sink, hole_sink, \
+    android_sparse_sink, compress_sink, hash_sink
 from struct import unpack, pack
 
 logger = logging.getLogger(__name__)
 import time
+import array
+import json
+import hashlib
+import mmap
+from concurrent.futures import ThreadPoolExecutor
 
 default_ids = [
     [0x0E8D, 0x0003, -1],
@@ -236,6 +250,178 @@ class GCPU:
         self.GCPU_REG_MEM_Slot = self.cryptobase + 0xC40
 
 
+class regscript:
+    # Queued brom read32/write32 commands sent in one write and checked in one read, a rejected command desyncs the rest
+
+    def __init__(self, mtk):
+        self.mtk = mtk
+        self.ops = []
+        self.cmd_write32 = mtk.mtkcmd.CMD_WRITE32.value
+        self.cmd_read32 = mtk.mtkcmd.CMD_READ32.value
+
+    def write32(self, addr, dwords):
+        # lists are kept by reference so a kept script picks up patched values
+        self.ops.append((self.cmd_write32, addr, dwords if isinstance(dwords, list) else list(dwords)))
+        return self
+
+    def read32(self, addr, dwords=1):
+        self.ops.append((self.cmd_read32, addr, dwords))
+        return self
+
+    def execute(self, reset=True):
+        # One result per command: True/False for writes, the dword list for reads; reset=False keeps the script for reruns
+        request = bytearray()
+        resplen = 0
+        for cmd, addr, dwords in self.ops:
+            if cmd == self.cmd_write32:
+                request += cmd + pack(">II", addr, len(dwords)) + pack(">%dI" % len(dwords), *dwords)
+                resplen += 1 + 4 + 4 + 2 + 4 * len(dwords) + 2
+            else:
+                request += cmd + pack(">II", addr, dwords)
+                resplen += 1 + 4 + 4 + 2 + 4 * dwords + 2
+        self.mtk.usbwrite(request)
+        response = self.mtk.usbread(resplen)
+        results = []
+        pos = 0
+        for cmd, addr, dwords in self.ops:
+            count = len(dwords) if cmd == self.cmd_write32 else dwords
+            oplen = 1 + 4 + 4 + 2 + 4 * count + 2
+            if len(response) < pos + oplen:
+                results.append(False if cmd == self.cmd_write32 else [])
+                continue
+            rcmd, raddr, rcount, status = unpack(">cIIH", response[pos:pos + 11])
+            data = response[pos + 11:pos + 11 + 4 * count]
+            status2 = unpack(">H", response[pos + 11 + 4 * count:pos + oplen])[0]
+            valid = rcmd == cmd and raddr == addr and rcount == count and status == 0 and status2 == 0
+            if cmd == self.cmd_write32:
+                results.append(valid and data == pack(">%dI" % count, *dwords))
+            else:
+                results.append(list(unpack(">%dI" % count, data)) if valid else [])
+            pos += oplen
+        if reset:
+            self.ops = []
+        return results
+
+
+class daloader(metaclass=LogBase):
+    # mmap'ed DA loader, its parsed index and region checksums are cached in <loader>.idx.json keyed by sha256
+    da_struct = struct.Struct("<" + "".join(stype for name, stype in DA))
+    region_struct = struct.Struct("<" + "".join(stype for name, stype in entry_region))
+    indexversion = 1
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.rf = open(filename, "rb")
+        self.data = mmap.mmap(self.rf.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.data)
+        self.indexname = filename + ".idx.json"
+        self._sha256 = None
+        self.checksums = {}
+        start = time.perf_counter()
+        self.setups = self.load_index()
+        source = "cached"
+        if self.setups is None:
+            self.setups = self.parse()
+            self.save_index()
+            source = "parsed"
+        self.build_lookup()
+        self.__logger.debug("Loader index %s, %d setups in %.2f ms" %
+                            (source, len(self.setups), (time.perf_counter() - start) * 1000))
+
+    @property
+    def sha256(self):
+        if self._sha256 is None:
+            self._sha256 = hashlib.sha256(self.view).hexdigest()
+        return self._sha256
+
+    def parse(self):
+        setups = []
+        count_da = unpack("<I", self.view[0x68:0x6C])[0]
+        for i in range(0, count_da):
+            pos = 0x6C + (i * 0xDC)
+            header = dict(zip([name for name, stype in DA], self.da_struct.unpack_from(self.view, pos)))
+            setup = [header]
+            pos += self.da_struct.size
+            for m in range(0, header["entry_region_count"]):
+                setup.append(dict(zip([name for name, stype in entry_region],
+                                      self.region_struct.unpack_from(self.view, pos))))
+                pos += self.region_struct.size
+            setups.append(setup)
+        return setups
+
+    def load_index(self):
+        try:
+            with open(self.indexname, "r") as rf:
+                index = json.load(rf)
+        except (OSError, ValueError):
+            return None
+        st = os.stat(self.filename)
+        if index.get("version") != self.indexversion:
+            return None
+        if index.get("size") == st.st_size and index.get("mtime_ns") == st.st_mtime_ns:
+            self._sha256 = index["sha256"]
+            self.checksums = index.get("checksums", {})
+        elif index.get("sha256") != self.sha256:
+            return None
+        else:
+            self.checksums = index.get("checksums", {})
+            # Same content under a new mtime, just refresh the stat info
+            self.save_index(index["setups"])
+        return index["setups"]
+
+    def save_index(self, setups=None):
+        st = os.stat(self.filename)
+        index = {"version": self.indexversion, "sha256": self.sha256, "size": st.st_size,
+                 "mtime_ns": st.st_mtime_ns, "setups": self.setups if setups is None else setups,
+                 "checksums": self.checksums}
+        try:
+            with open(self.indexname + ".tmp", "w") as wf:
+                json.dump(index, wf)
+            os.replace(self.indexname + ".tmp", self.indexname)
+        except OSError as e:
+            self.__logger.debug("Couldn't write loader index: " + str(e))
+
+    def build_lookup(self):
+        # (hw_code, hw_version, sw_version), (hw_code, hw_version) and (hw_code,) to the
+        # first setup with that key, the same one a linear scan in loader order finds
+        self.lookup = {}
+        for setup in self.setups:
+            header = setup[0]
+            key = (header["hw_code"], header["hw_version"], header["sw_version"])
+            for length in (3, 2, 1):
+                self.lookup.setdefault(key[:length], setup)
+
+    def find(self, hwcode, hwver, swver):
+        # Setup and match kind, falling back from exact to hw_code+hw_version to hw_code
+        key = (hwcode, hwver, swver)
+        for length, match in ((3, "exact"), (2, "hw_code+hw_version"), (1, "hw_code")):
+            setup = self.lookup.get(key[:length])
+            if setup is not None:
+                return setup, match
+        return None, None
+
+    def stage(self, setup, stage):
+        # Payload of an entry region as a slice of the mapping, no copy
+        region = setup[stage]
+        return self.view[region["m_buf"]:region["m_buf"] + region["m_len"]]
+
+    def checksum(self, setup, stage):
+        # xor16 of a stage payload, computed once per loader content and region
+        region = setup[stage]
+        key = "%x:%x" % (region["m_buf"], region["m_len"])
+        if key not in self.checksums:
+            self.checksums[key] = xor16(self.stage(setup, stage))
+            self.save_index()
+        return self.checksums[key]
+
+    def close(self):
+        if self.data is not None:
+            self.view.release()
+            self.data.close()
+            self.rf.close()
+            self.data = None
+
+
 class Mtk(metaclass=LogBase):
     class mtktypes(Enum):
         M_EMMC = 1
@@ -419,7 +605,7 @@ class Mtk(metaclass=LogBase):
         UART_BAUD_230400 = b'\x03'
         UART_BAUD_115200 = b'\x04'
 
-    def __init__(self, args, loader, loglevel=logging.INFO, vid=-1, pid=-1, interface=0, pagesize=512):
+    def __init__(self, args, loader, loglevel=logging.INFO, vid=-1, pid=-1, interface=0, pagesize=512, trace=None):
         filename = "log.txt"
         da_address = args["--da_addr"]
         if da_address == None:
@@ -469,7 +655,47 @@ class Mtk(metaclass=LogBase):
         else:
             self.__logger.setLevel(logging.INFO)
         self.cdc = usb_class(portconfig=portconfig, loglevel=loglevel)
+        self.rxbuffer = bytearray()
+        self.rxpos = 0
+        self.usbtimeout = 5000
+        self.verify_checksum = True
+        self.readretries = 3
+        self.streamreadsize = 0x1000000
+        self.gptcache = {}
+        # Stage 2 upload: bytes per packet and how many packet acks may be outstanding
+        self.da_packetsize = 0x1000
+        self.da_ackwindow = 8
+        self.sparse = args["--sparse"]
+        if self.sparse not in [None, "android", "holes"]:
+            self.__logger.error("Unknown sparse mode " + self.sparse + ", use android or holes.")
+            exit(1)
+        self.compress = args["--compress"]
+        self.compresspool = None
+        if self.compress is not None:
+            if self.compress not in compress_sink.extensions:
+                self.__logger.error("Unknown compression method " + self.compress + ", use gzip, xz or zstd.")
+                exit(1)
+            if not compress_sink.available(self.compress):
+                self.__logger.error(self.compress + " compression needs the zstandard module.")
+                exit(1)
+            if self.sparse is not None:
+                self.__logger.error("--sparse and --compress can't be combined.")
+                exit(1)
+            if args["--resume"]:
+                self.__logger.error("--resume and --compress can't be combined, a compressed dump can't be resumed.")
+                exit(1)
+        self.hashes = [] if args["--hash"] is None else args["--hash"].split(",")
+        for algorithm in self.hashes:
+            if algorithm not in hashlib.algorithms_available:
+                self.__logger.error("Unknown hash algorithm " + algorithm)
+                exit(1)
+        if args["--async-depth"] is not None:
+            self.cdc.async_depth = getint(args["--async-depth"])
+            self.cdc.async_size = getint(args["--async-size"])
+        self.cdc.trace = trace
         self.packetsizeread = 0x400
+        # ms to wait for each handshake byte
+        self.handshaketimeout = 100
         self.flashinfo = None
         self.flashsize = 0
         self.readsize = 0
@@ -483,27 +709,17 @@ class Mtk(metaclass=LogBase):
             self.__logger.error("Couldn't open " + loader)
             exit(0)
 
-        self.da_setup = []
-        with open(loader, 'rb') as bootldr:
-            bootldr.seek(0x68)
-            count_da = struct.unpack("<I", bootldr.read(4))[0]
-            for i in range(0, count_da):
-                bootldr.seek(0x6C + (i * 0xDC))
-                datmp = read_object(bootldr.read(0x14), DA)  # hdr
-                da = [datmp]
-                # bootldr.seek(0x6C + (i * 0xDC) + 0x14) #sections
-                for m in range(0, datmp["entry_region_count"]):
-                    entry_tmp = read_object(bootldr.read(20), entry_region)
-                    da.append(entry_tmp)
-                self.da_setup.append(da)
+        self.daloader = daloader(loader)
+        self.da_setup = self.daloader.setups
 
     def usbwrite(self, data):
-        size = self.cdc.write(data, len(data))
+        size = self.cdc.write(data)
         # port->flush()
         return size
 
     def close(self):
         self.cdc.close()
+        self.daloader.close()
 
     def usbreadwrite(self, data, resplen):
         size = self.usbwrite(data)
@@ -511,23 +727,73 @@ class Mtk(metaclass=LogBase):
         res = self.usbread(resplen)
         return res
 
-    def usbread(self, resplen):
-        res = b""
-        timeout = 0
-        while (resplen > 0):
-            tmp = self.cdc.read(resplen)
-            if tmp == b"":
-                if timeout == 4:
+    def usbread(self, resplen, timeout=None):
+        # Served from the receive buffer, refilled with whole packets for at most timeout ms
+        available = len(self.rxbuffer) - self.rxpos
+        if available < resplen:
+            if timeout is None:
+                timeout = self.usbtimeout
+            deadline = time.time() + timeout / 1000
+            maxpacketsize = self.cdc.maxpacketsize_in
+            while available < resplen:
+                remaining = int((deadline - time.time()) * 1000)
+                if remaining <= 0:
                     break
-                timeout += 1
-                time.sleep(0.1)
-            resplen -= len(tmp)
-            res += tmp
+                # request whole packets, so a device sending more than asked can't overflow us
+                size = min(-(-(resplen - available) // maxpacketsize) * maxpacketsize, self.cdc.max_transfer_size)
+                tmp = self.cdc.read(size, remaining)
+                if self.rxpos > 0:
+                    del self.rxbuffer[:self.rxpos]
+                    self.rxpos = 0
+                self.rxbuffer += tmp
+                available = len(self.rxbuffer)
+        res = bytes(self.rxbuffer[self.rxpos:self.rxpos + resplen])
+        self.rxpos += len(res)
+        if self.rxpos == len(self.rxbuffer):
+            self.rxbuffer.clear()
+            self.rxpos = 0
         return res
 
+    def usbreadinto(self, buffer, timeout=None, idle=False):
+        # Fills the given preallocated buffer, returns the number of bytes received.
+        # With idle, timeout counts from the last data received instead of from the start.
+        length = memoryview(buffer).nbytes
+        view = None
+        pos = 0
+        if self.rxpos < len(self.rxbuffer):
+            view = memoryview(buffer).cast('B')
+            pos = min(len(self.rxbuffer) - self.rxpos, length)
+            view[:pos] = self.rxbuffer[self.rxpos:self.rxpos + pos]
+            self.rxpos += pos
+            if self.rxpos == len(self.rxbuffer):
+                self.rxbuffer.clear()
+                self.rxpos = 0
+        if timeout is None:
+            timeout = self.usbtimeout
+        deadline = time.time() + timeout / 1000
+        while pos < length:
+            remaining = int((deadline - time.time()) * 1000)
+            if remaining <= 0:
+                break
+            if pos == 0:
+                size = self.cdc.readinto(buffer, remaining)
+            else:
+                if view is None:
+                    view = memoryview(buffer).cast('B')
+                size = self.cdc.readinto(view[pos:], remaining)
+            pos += size
+            if idle and size > 0:
+                deadline = time.time() + timeout / 1000
+        return pos
+
     def get_gpt(self, gpt_num_part_entries, gpt_part_entry_size, gpt_part_entry_start_lba):
-        data = self.readflash(0, 2 * self.pagesize, "", False)
-        if data == b"":
+        # Primary gpt in one 34 sector read, or the backup's table and data if it fails its crcs; cached until a write
+        key = (self.flash, gpt_num_part_entries, gpt_part_entry_size, gpt_part_entry_start_lba)
+        if key in self.gptcache:
+            data, guid_gpt, index = self.gptcache[key]
+            return data, guid_gpt
+        data = self.readflash(0, 34 * self.pagesize, "", False)
+        if not data:
             return None, None
         guid_gpt = gpt(
             num_part_entries=gpt_num_part_entries,
@@ -535,83 +801,141 @@ class Mtk(metaclass=LogBase):
             part_entry_start_lba=gpt_part_entry_start_lba,
         )
         header = guid_gpt.parseheader(data, self.pagesize)
-        if "first_usable_lba" in header:
+        if not guid_gpt.check_header_crc(data, self.pagesize):
+            self.__logger.warning("Primary gpt header is corrupt, trying the backup gpt.")
+            data, guid_gpt = self.get_backup_gpt(gpt_num_part_entries, gpt_part_entry_size,
+                                                 gpt_part_entry_start_lba)
+            if guid_gpt is None:
+                return None, None
+        else:
             sectors = header["first_usable_lba"]
             if sectors == 0:
                 return None, None
-            data = self.readflash(0, sectors * self.pagesize, "", False)
-            if data == b"":
-                return None, None
-            guid_gpt.parse(data, self.pagesize)
-            return data, guid_gpt
-        else:
-            return None, None
-
-    def get_backup_gpt(self, lun, gpt_num_part_entries, gpt_part_entry_size, gpt_part_entry_start_lba):
-        data = self.readflash(0, 2 * self.pagesize, "", False)
-        if data == b"":
+            if sectors > 34:
+                rest = self.readflash(34 * self.pagesize, (sectors - 34) * self.pagesize, "", False)
+                if not rest:
+                    return None, None
+                data += rest
+            else:
+                del data[sectors * self.pagesize:]
+            if not guid_gpt.parse(data, self.pagesize):
+                self.__logger.warning("Primary gpt entries are corrupt, trying the backup gpt.")
+                data, guid_gpt = self.get_backup_gpt(gpt_num_part_entries, gpt_part_entry_size,
+                                                     gpt_part_entry_start_lba, header["backup_lba"],
+                                                     header["num_part_entries"] * header["part_entry_size"])
+                if guid_gpt is None:
+                    return None, None
+        index = {}
+        for partition in guid_gpt.partentries:
+            index.setdefault(partition.name, partition)
+        self.gptcache[key] = (data, guid_gpt, index)
+        return data, guid_gpt
+
+    def gptfiles(self, data, guid_gpt, backupstart):
+        # (filename, data) of the gpt dump files, data[backupstart:] is the backup part of a primary gpt
+        if guid_gpt.header["current_lba"] == 1:
+            return [("gpt_main.bin", data), ("gpt_backup.bin", data[backupstart:])]
+        self.__logger.warning("Primary gpt is corrupt, only the backup gpt is written, as gpt_backup.bin.")
+        return [("gpt_backup.bin", data)]
+
+    def get_partition(self, name, gpt_num_part_entries, gpt_part_entry_size, gpt_part_entry_start_lba):
+        # Looks up a gpt entry by name through the cached index, None if there is none
+        data, guid_gpt = self.get_gpt(gpt_num_part_entries, gpt_part_entry_size, gpt_part_entry_start_lba)
+        if guid_gpt is None:
             return None
+        key = (self.flash, gpt_num_part_entries, gpt_part_entry_size, gpt_part_entry_start_lba)
+        return self.gptcache[key][2].get(name)
+
+    def get_backup_gpt(self, gpt_num_part_entries, gpt_part_entry_size, gpt_part_entry_start_lba, backup_lba=0,
+                       entries_size=0x4000):
+        # Backup header at backup_lba (default: last sector) and the entries in front of it in one read, or None, None
+        if backup_lba == 0:
+            backup_lba = self.flashsize // self.pagesize - 1
+        if backup_lba <= 0:
+            return None, None
         guid_gpt = gpt(
             num_part_entries=gpt_num_part_entries,
             part_entry_size=gpt_part_entry_size,
             part_entry_start_lba=gpt_part_entry_start_lba,
         )
-        header = guid_gpt.parseheader(data, self.cfg.SECTOR_SIZE_IN_BYTES)
-        if "backup_lba" in header:
-            sectors = header["first_usable_lba"] - 1
-            data = self.readflash(header["backup_lba"] * self.pagesize, sectors * self.pagesize, "", False)
-            if data == b"":
-                return None
-            return data
-        else:
-            return None
+        startlba = max(backup_lba - (entries_size + self.pagesize - 1) // self.pagesize, 0)
+        data = self.readflash(startlba * self.pagesize, (backup_lba - startlba + 1) * self.pagesize, "", False)
+        if not data or not guid_gpt.check_header_crc(data, self.pagesize, backup_lba, startlba):
+            self.__logger.error("Backup gpt header is corrupt too.")
+            return None, None
+        header = guid_gpt.parseheader(data, self.pagesize, backup_lba, startlba)
+        entrylba = header["part_entry_start_lba"]
+        if entrylba < startlba:
+            # The entry array is larger than expected, fetch the part in front
+            rest = self.readflash(entrylba * self.pagesize, (startlba - entrylba) * self.pagesize, "", False)
+            if not rest:
+                return None, None
+            data = rest + data
+            startlba = entrylba
+        if not guid_gpt.parse(data, self.pagesize, backup_lba, startlba):
+            return None, None
+        return data, guid_gpt
 
     def detect(self, loop=0):
-        while not self.cdc.connected:
-            self.cdc.connected = self.cdc.connect()
-            if self.cdc.connected:
-                startcmd = [b"\xa0", b"\x0a", b"\x50", b"\x05"]
-                respcmd = b"\x5F\xF5\xAF\xFA"
-                tries = 100
-                i = 0
-                length = len(startcmd)
-                while i < length and tries > 0:
-                    cmd = startcmd[i]
-                    res = respcmd[i]
-                    r = self.usbwrite(cmd)
-                    # if r > 0:
-                    #    logger.debug("TX: "+hex(startcmd[i]))
-                    v = self.cdc.read(self.packetsizeread)
-                    try:
-                        self.cdc.setLineCoding(115200)
-                        self.__logger.info("Setting 115200")
-                    except:
-                        pass
-                    if len(v) < 1:
-                        logger.debug("Timeout")
-                        i = 0
-                        time.sleep(0.005)
-                    elif v[0] == res:
-                        # logger.debug("RX OK: "+hex(startcmd[i])+"->"+hex(respcmd[i]))
-                        i += 1
-                    else:
-                        self.cdc.setLineCoding(115200)
-                        self.__logger.info("Setting 115200")
-                        i = 0
-                    tries -= 1
-                print()
-                self.__logger.info("Device detected :)")
-                return True
-            else:
-                sys.stdout.write('.')
-                if loop >= 20:
-                    sys.stdout.write('\n')
-                    loop = 0
-                loop += 1
-                time.sleep(0.3)
-                sys.stdout.flush()
+        def idle():
+            nonlocal loop
+            sys.stdout.write('.')
+            if loop >= 20:
+                sys.stdout.write('\n')
+                loop = 0
+            loop += 1
+            sys.stdout.flush()
+
+        if not self.cdc.connected:
+            self.cdc.connected = self.cdc.wait_connect(idle=idle)
+        if self.cdc.connected:
+            if not self.handshake():
+                self.__logger.error("Handshake failed")
+                return False
+            print()
+            self.__logger.info("Device detected :)")
+            return True
         return False
 
+    def handshake(self, tries=100):
+        # a0 0a 50 05 must each come back inverted, a timeout or wrong byte starts over
+        startcmd = b"\xa0\x0a\x50\x05"
+        timings = []
+        start = time.perf_counter()
+        try:
+            self.cdc.setLineCoding(115200)
+        except Exception:
+            pass
+        timings.append(("line coding", time.perf_counter() - start))
+
+        start = time.perf_counter()
+        self.rxbuffer.clear()
+        self.rxpos = 0
+        drained = 0
+        for attempt in range(64):
+            stale = self.cdc.read(self.packetsizeread, 10)
+            if len(stale) == 0:
+                break
+            drained += len(stale)
+        timings.append(("drain", time.perf_counter() - start))
+
+        start = time.perf_counter()
+        state = 0
+        while state < len(startcmd) and tries > 0:
+            self.usbwrite(startcmd[state:state + 1])
+            v = self.cdc.read(self.packetsizeread, self.handshaketimeout)
+            # The answer to our byte is the last one received
+            if len(v) > 0 and v[-1] == startcmd[state] ^ 0xFF:
+                state += 1
+            else:
+                state = 0
+            tries -= 1
+        timings.append(("sync", time.perf_counter() - start))
+        self.__logger.debug("Handshake: " + ", ".join("%s %.1f ms" % (phase, elapsed * 1000)
+                                                      for phase, elapsed in timings) +
+                            ", %d stale bytes" % drained)
+        return state == len(startcmd)
+
     def mtk_cmd(self, value, bytestoread=0, nocmd=False):
         resp = b""
         dlen = len(value)
@@ -700,37 +1024,67 @@ class Mtk(metaclass=LogBase):
             return False  # S-USBDL disabled
         return True
 
-    def da_send(self, address, size, sig_len, dadata):
+    def da_send(self, address, size, sig_len, dadata, checksum=None):
         cmd = self.mtkcmd.CMD_SEND_DA.value + pack(">III", address, size, sig_len)
         res = self.mtk_cmd(cmd, 2)  # 0xD4
         if res != -1:
             status = unpack(">H", res)[0]
             if status == 0:
-                for pos in range(0, size, sig_len):
-                    self.usbwrite(dadata[pos:pos + sig_len])
+                # One transfer of the announced size, usb_class.write splits it without copying
+                dadata = memoryview(dadata)[:size]
+                self.usbwrite(dadata)
+                # The BROM expects a zero length packet after the DA data
                 wr = self.usbwrite(b"")
                 res2 = self.usbread(4)
-                checksum, status = unpack(">HH", res2)
+                if len(res2) < 4:
+                    self.__logger.error("No checksum from the BROM after the DA upload")
+                    return False
+                devchecksum, status = unpack(">HH", res2)
+                if checksum is None:
+                    checksum = xor16(dadata)
+                if devchecksum != checksum:
+                    self.__logger.error("DA checksum mismatch: expected " + hex(checksum) + ", got " + hex(devchecksum))
+                    return False
                 if status == 0x0:
                     return address
+                self.__logger.error("DA upload failed, status " + hex(status))
             else:
+                self.__logger.error("CMD_SEND_DA failed, status " + hex(status))
                 return False
         return False
 
-    def brom_send(self, dasetup, da, stage, packetsize=0x1000):
-        offset = dasetup[stage]["m_buf"]
+    def brom_send(self, dasetup, stage, packetsize=None):
+        # Packets go out back to back with up to da_ackwindow acks outstanding, returns flashinfo or -1
+        if packetsize is None:
+            packetsize = self.da_packetsize
         size = dasetup[stage]["m_len"]
         address = dasetup[stage]["m_start_addr"]
-        da.seek(offset)
-        dadata = da.read(size)
+        dadata = self.daloader.stage(dasetup, stage)
         self.usbwrite(pack(">I", address))
         self.usbwrite(pack(">I", size))
         self.usbwrite(pack(">I", packetsize))
-        buffer = self.usbread(1)
+        ack = self.usbread(1)
+        if ack != self.mtkcmd.ACK.value:
+            if packetsize != 0x1000:
+                self.__logger.warning("DA didn't accept a packet size of " + hex(packetsize) + ", retrying with 0x1000")
+                return self.brom_send(dasetup, stage, 0x1000)
+            self.__logger.error("DA didn't accept a packet size of " + hex(packetsize))
+            return -1
+        start = time.perf_counter()
+        outstanding = 0
         for pos in range(0, size, packetsize):
+            if outstanding == self.da_ackwindow:
+                if self.usbread(1) != self.mtkcmd.ACK.value:
+                    self.__logger.error("DA didn't ack packet at " + hex(pos - outstanding * packetsize))
+                    return -1
+                outstanding -= 1
             self.usbwrite(dadata[pos:pos + packetsize])
-            buffer = self.usbread(1)
-        time.sleep(0.5)
+            outstanding += 1
+        acks = self.usbread(outstanding)
+        if acks != self.mtkcmd.ACK.value * outstanding:
+            self.__logger.error("DA didn't ack the last packets")
+            return -1
+        self.__logger.debug("Sent stage %d, %d bytes in %.3f s" % (stage, size, time.perf_counter() - start))
         self.usbwrite(self.mtkcmd.ACK.value)
         buffer = self.usbread(1)
         data = self.usbread(0xEC)
@@ -771,38 +1125,45 @@ class Mtk(metaclass=LogBase):
                 res3 = unpack(">I", self.usbread(4))[0]
                 status = unpack(">H", self.usbread(2))[0]
                 if res3 == len(dwords):
-                    for dword in dwords:
-                        self.usbwrite(pack(">I", dword))
-                        resdword = unpack(">I", self.usbread(4))[0]
-                        if resdword != dword:
-                            break
+                    # Stream all dwords at once and check the echoes in bulk afterwards
+                    data = pack(">%dI" % len(dwords), *dwords)
+                    self.usbwrite(data)
+                    if self.usbread(len(data)) != data:
+                        self.__logger.debug("Write32 echo mismatch at " + hex(addr))
                     status2 = unpack(">H", self.usbread(2))[0]
                     if status2 == 0:
                         return True
         return False
 
+    def regscript(self):
+        return regscript(self)
+
     def gcpu_init(self):
-        self.da_write32(self.gcpu.GCPU_REG_MEM_P2, [0x0])
-        self.da_write32(self.gcpu.GCPU_REG_MEM_P3, [0x0])
-        self.da_write32(self.gcpu.GCPU_REG_MEM_P4, [0x0])
-        self.da_write32(self.gcpu.GCPU_REG_MEM_P5, [0x0])
-        self.da_write32(self.gcpu.GCPU_REG_MEM_P6, [0x0])
-        self.da_write32(self.gcpu.GCPU_REG_MEM_P7, [0x0])
-        self.da_write32(self.gcpu.GCPU_REG_MEM_P8, [0x0])
-        self.da_write32(self.gcpu.GCPU_REG_MEM_P9, [0x0])
-        self.da_write32(self.gcpu.GCPU_REG_MEM_P10, [0x0])
-        self.da_write32(self.gcpu.GCPU_REG_MEM_CMD + 18 * 4, [0, 0, 0, 0])
-        self.da_write32(self.gcpu.GCPU_REG_MEM_CMD + 22 * 4, [0, 0, 0, 0])
-        self.da_write32(self.gcpu.GCPU_REG_MEM_CMD + 26 * 4, [0, 0, 0, 0, 0, 0, 0, 0])
+        script = self.regscript()
+        script.write32(self.gcpu.GCPU_REG_MEM_P2, [0x0])
+        script.write32(self.gcpu.GCPU_REG_MEM_P3, [0x0])
+        script.write32(self.gcpu.GCPU_REG_MEM_P4, [0x0])
+        script.write32(self.gcpu.GCPU_REG_MEM_P5, [0x0])
+        script.write32(self.gcpu.GCPU_REG_MEM_P6, [0x0])
+        script.write32(self.gcpu.GCPU_REG_MEM_P7, [0x0])
+        script.write32(self.gcpu.GCPU_REG_MEM_P8, [0x0])
+        script.write32(self.gcpu.GCPU_REG_MEM_P9, [0x0])
+        script.write32(self.gcpu.GCPU_REG_MEM_P10, [0x0])
+        script.write32(self.gcpu.GCPU_REG_MEM_CMD + 18 * 4, [0, 0, 0, 0])
+        script.write32(self.gcpu.GCPU_REG_MEM_CMD + 22 * 4, [0, 0, 0, 0])
+        script.write32(self.gcpu.GCPU_REG_MEM_CMD + 26 * 4, [0, 0, 0, 0, 0, 0, 0, 0])
+        return script.execute()
 
     def gcpu_acquire(self):
         self.da_write32(self.gcpu.cryptobase, [0x1F, 0x12000])
 
     def gcpu_call_func(self, func):
-        self.da_write32(self.gcpu.GCPU_REG_INT_CLR, [3])
-        self.da_write32(self.gcpu.GCPU_REG_INT_EN, [3])
-        self.da_write32(self.gcpu.GCPU_REG_MEM_CMD, [func])
-        self.da_write32(self.gcpu.GCPU_REG_PC_CTL, [0])
+        script = self.regscript()
+        script.write32(self.gcpu.GCPU_REG_INT_CLR, [3])
+        script.write32(self.gcpu.GCPU_REG_INT_EN, [3])
+        script.write32(self.gcpu.GCPU_REG_MEM_CMD, [func])
+        script.write32(self.gcpu.GCPU_REG_PC_CTL, [0])
+        script.execute()
         while not self.da_read32(self.gcpu.GCPU_REG_INT_SET)[0]:
             pass
         if self.da_read32(self.gcpu.GCPU_REG_INT_SET)[0] & 2:
@@ -833,6 +1194,50 @@ class Mtk(metaclass=LogBase):
             data += pack("<I", word)
         return data
 
+    def aes_read_pipelined(self, start, length):
+        # Yields (addr, 16 bytes) like aes_read16, with one setup and one adaptive poll script per block
+        gcpu = self.gcpu
+        params = [0, 0, 1, 0, 18, 26, 26]  # P0..P6, P3 is zeroed by gcpu_init anyway
+        setup = self.regscript()
+        setup.write32(gcpu.GCPU_REG_MEM_P0, params)
+        setup.write32(gcpu.GCPU_REG_INT_CLR, [3, 3])  # INT_CLR, INT_EN
+        setup.write32(gcpu.GCPU_REG_MEM_CMD, [126])  # aes decrypt
+        setup.write32(gcpu.GCPU_REG_PC_CTL, [0])
+        poll = self.regscript()
+        poll.read32(gcpu.GCPU_REG_INT_SET)
+        poll.read32(gcpu.cryptobase + 0x418)
+        poll.read32(gcpu.GCPU_REG_MEM_CMD + 26 * 4, 4)  # IV slot
+        delay = 0
+        for addr in range(start, start + length, 16):
+            params[0] = addr
+            if not all(setup.execute(reset=False)):
+                raise RuntimeError("failed to set up the function at " + hex(addr))
+            if delay:
+                time.sleep(delay)
+            wait = delay
+            polls = 0
+            while True:
+                intset, status, iv = poll.execute(reset=False)
+                polls += 1
+                if not intset or not status or not iv:
+                    raise RuntimeError("failed to poll the function at " + hex(addr))
+                if intset[0] & 2:
+                    self.da_write32(gcpu.GCPU_REG_INT_CLR, [3])
+                    raise RuntimeError("failed to call the function!")
+                if intset[0] and status[0] & 1:
+                    break
+                wait = min(max(wait * 2, 0.0002), 0.01)
+                time.sleep(wait)
+            # Converge on the delay that makes the first poll succeed
+            if polls > 1:
+                delay = wait
+            elif delay < 0.0002:
+                delay = 0
+            else:
+                delay /= 2
+            yield addr, pack("<4I", *iv)
+        self.da_write32(gcpu.GCPU_REG_INT_CLR, [3])
+
     def aes_write16(self, addr, data):
         if len(data) != 16:
             raise RuntimeError("data must be 16 bytes")
@@ -847,19 +1252,21 @@ class Mtk(metaclass=LogBase):
             pat = unpack("<I", pattern[x * 4:(x + 1) * 4])[0]
             words.append(word ^ pat)
 
-        self.da_write32(self.gcpu.GCPU_REG_MEM_CMD + 18 * 4, [0, 0, 0, 0])
-        self.da_write32(self.gcpu.GCPU_REG_MEM_CMD + 22 * 4, [0, 0, 0, 0])
-        self.da_write32(self.gcpu.GCPU_REG_MEM_CMD + 26 * 4, [0, 0, 0, 0, 0, 0, 0, 0])
+        script = self.regscript()
+        script.write32(self.gcpu.GCPU_REG_MEM_CMD + 18 * 4, [0, 0, 0, 0])
+        script.write32(self.gcpu.GCPU_REG_MEM_CMD + 22 * 4, [0, 0, 0, 0])
+        script.write32(self.gcpu.GCPU_REG_MEM_CMD + 26 * 4, [0, 0, 0, 0, 0, 0, 0, 0])
 
-        self.da_write32(self.gcpu.GCPU_REG_MEM_CMD + 26 * 4, [words])
+        script.write32(self.gcpu.GCPU_REG_MEM_CMD + 26 * 4, words)
 
         # src to VALID address which has all zeroes (otherwise, update pattern)
-        self.da_write32(self.gcpu.GCPU_REG_MEM_P0, [0])
-        self.da_write32(self.gcpu.GCPU_REG_MEM_P1, [addr])  # dst to our destination
-        self.da_write32(self.gcpu.GCPU_REG_MEM_P2, [1])
-        self.da_write32(self.gcpu.GCPU_REG_MEM_P4, [18])
-        self.da_write32(self.gcpu.GCPU_REG_MEM_P5, [26])
-        self.da_write32(self.gcpu.GCPU_REG_MEM_P6, [26])
+        script.write32(self.gcpu.GCPU_REG_MEM_P0, [0])
+        script.write32(self.gcpu.GCPU_REG_MEM_P1, [addr])  # dst to our destination
+        script.write32(self.gcpu.GCPU_REG_MEM_P2, [1])
+        script.write32(self.gcpu.GCPU_REG_MEM_P4, [18])
+        script.write32(self.gcpu.GCPU_REG_MEM_P5, [26])
+        script.write32(self.gcpu.GCPU_REG_MEM_P6, [26])
+        script.execute()
         if self.gcpu_call_func(126) != 0:  # aes decrypt
             raise RuntimeError("failed to call the function!")
 
@@ -959,43 +1366,76 @@ class Mtk(metaclass=LogBase):
             print_progress(0, 100, prefix='Progress:', suffix='Complete', bar_length=50)
             old = 0
             with open(filename, 'wb') as wf:
-                for addr in range(0x0, 0x20000, 16):
+                for addr, data in self.aes_read_pipelined(0x0, 0x20000):
                     prog = int(addr / 0x20000 * 100)
                     if int(prog) > old:
                         print_progress(prog, 100, prefix='Progress:', suffix='Complete, addr %08X' % addr,
                                        bar_length=50)
                         old = prog
-                    wf.write(self.aes_read16(addr))
+                    wf.write(data)
             print_progress(100, 100, prefix='Progress:', suffix='Complete', bar_length=50)
             self.__logger.info("Bootrom dumped as: " + filename)
+            return True
         elif type=="kamakiri":
             self.__logger.info("Kamakiri / DA Run")
+            socname = hwcodetable.get(self.hwcode, "").split(" ")[0]
+            bulkpayload = os.path.join("payloads", socname + "_bulk_dump_payload.bin")
+            if socname != "" and os.path.exists(bulkpayload):
+                if self.payload(bulkpayload):
+                    return self.dump_brom_bulk(filename)
+                return False
             if self.payload(os.path.join("payloads","generic_dump_payload.bin")):
                 result = self.usbread(4)
                 if result == pack(">I", 0xC1C2C3C4):
-                    old=0
+                    # usbdl_put_dword of the byteswapped words, arrives in memory order, one
+                    # short transfer per word, so the timeout only covers gaps in the stream
+                    data = array.array('B', bytes(0x20000))
+                    if self.usbreadinto(data, idle=True) != len(data):
+                        self.__logger.error("Error: bootrom dump is incomplete.")
+                        return False
                     with open(filename, 'wb') as wf:
-                        print_progress(0, 100, prefix='Progress:', suffix='Complete', bar_length=50)
-                        for addr in range(0x0, 0x20000, 16):
-                            prog = int(addr / 0x20000 * 100)
-                            if int(prog) > old:
-                                print_progress(prog, 100, prefix='Progress:', suffix='Complete, addr %08X' % addr,
-                                               bar_length=50)
-                                old = prog
-                        print_progress(100, 100, prefix='Progress:', suffix='Complete', bar_length=50)
-                        self.__logger.info("Bootrom dumped as: "+filename)
+                        wf.write(data)
+                    self.__logger.info("Bootrom dumped as: "+filename)
                     return True
                 elif result==pack(">I", 0x0000C1C2):
                     self.__logger.info("Word mode detected.")
                     result=self.usbread(4)
                     if result==pack(">I", 0xC1C2C3C4):
+                        # Each dword comes as 8 bytes, the payload is in the second half
+                        data = array.array('I', [0]) * (0x20000 * 2 // 4)
+                        if self.usbreadinto(data, idle=True) != len(data) * data.itemsize:
+                            self.__logger.error("Error: bootrom dump is incomplete.")
+                            return False
                         with open(filename, "wb") as wf:
-                            for i in range(0x20000 // 4):
-                                data=self.usbread(8)
-                                wf.write(data[4:])
+                            wf.write(data[1::2])
                         self.__logger.info("Bootrom dumped as: " + filename)
                         return True
-                self.__logger.error("Error: "+hexlify(result))
+                self.__logger.error("Error: "+hexlify(result).decode('utf-8'))
+        return False
+
+    def dump_brom_bulk(self, filename):
+        # Magic dword, then 4 KiB chunks each followed by the 32-bit sum of its words
+        result = self.usbread(4)
+        if result != pack("<I", 0xB1B2B3B4):
+            self.__logger.error("Error: "+hexlify(result).decode('utf-8'))
+            return False
+        chunksize = 0x1000
+        chunk = array.array('I', [0]) * ((chunksize + 4) // 4)
+        with open(filename, 'wb') as wf:
+            print_progress(0, 100, prefix='Progress:', suffix='Complete', bar_length=50)
+            for addr in range(0x0, 0x20000, chunksize):
+                if self.usbreadinto(chunk) != chunksize + 4:
+                    self.__logger.error("Error: short read at " + hex(addr))
+                    return False
+                data = chunk[:-1]
+                if sum(data) & 0xFFFFFFFF != chunk[-1]:
+                    self.__logger.error("Error: checksum mismatch at " + hex(addr))
+                    return False
+                wf.write(data)
+                print_progress(int((addr + chunksize) / 0x20000 * 100), 100, prefix='Progress:',
+                               suffix='Complete, addr %08X' % addr, bar_length=50)
+        self.__logger.info("Bootrom dumped as: " + filename)
+        return True
 
     def get_watchdog_addr(self, hwcode):
         if self.watchdog_addr==0:
@@ -1160,68 +1600,71 @@ class Mtk(metaclass=LogBase):
         elif hwcode == 0x6582:
             newcombo = 0
             self.usbwrite(pack(">I", newcombo))
-        time.sleep(0.350)
         buffer = self.usbread(toread)
         return buffer
 
     def da_upload(self, hwcode, blver, daconfig):
         if blver == 0x01:
             self.__logger.info("Uploading stage 1...")
-            with open(self.loader, 'rb') as bootldr:
-                # stage 1
-                stage = blver + 1
-                offset = self.da_setup[stage]["m_buf"]
-                size = self.da_setup[stage]["m_len"]
-                address = self.da_setup[stage]["m_start_addr"]
-                sig_len = self.da_setup[stage]["m_sig_len"]
-                bootldr.seek(offset)
-                dadata = bootldr.read(size)
-                addr = self.da_send(address, size, sig_len, dadata)
-                if addr != False:
-                    if self.da_jump_da(addr):
-                        sync = self.usbread(1)
-                        if sync != b"\xC0":
-                            self.__logger.error("Error on DA sync")
-                            return
-                nandinfo = unpack(">I", self.usbread(4))[0]
-                ids = unpack(">H", self.usbread(2))[0]
-                nandids = []
-                for i in range(0, ids):
-                    tmp = unpack(">H", self.usbread(2))[0]
-                    nandids.append(tmp)
-
-                emmcinfo = unpack(">I", self.usbread(4))[0]
-                emmcids = []
-                for i in range(0, 4):
-                    tmp = unpack(">I", self.usbread(4))[0]
-                    emmcids.append(tmp)
-
-                if nandids[0] != 0:
-                    self.flash = "nand"
-                elif emmcids[0] != 0:
-                    self.flash = "emmc"
-                else:
-                    self.flash = "nor"
-
-                self.usbwrite(self.mtkcmd.ACK.value)
-                ackval = self.usbread(3)
-
-                self.usbwrite(self.mtkcmd.CMD_GET_VERSION.value)
-                self.usbwrite(pack("B", blver))
-
-                buffer = self.set_stage2_config(hwcode)
-                self.__logger.info("Uploading stage 2...")
-                # stage 2
-                flashinfo = self.brom_send(daconfig, bootldr, blver + 2)
-                if self.flash == "nand":
-                    self.flashsize = flashinfo["m_nand_flash_size"]
-                elif self.flash == "emmc":
-                    self.flashsize = flashinfo["m_emmc_ua_size"]
-                    if self.flashsize == 0:
-                        self.flashsize = flashinfo["m_sdmmc_ua_size"]
-                elif self.flash == "nor":
-                    self.flashsize = flashinfo["m_nor_flash_size"]
-                return flashinfo
+            # stage 1
+            stage = blver + 1
+            size = daconfig[stage]["m_len"]
+            address = daconfig[stage]["m_start_addr"]
+            sig_len = daconfig[stage]["m_sig_len"]
+            dadata = self.daloader.stage(daconfig, stage)
+            addr = self.da_send(address, size, sig_len, dadata, self.daloader.checksum(daconfig, stage))
+            if addr == False:
+                self.__logger.error("Error on uploading stage 1")
+                return -1
+            if not self.da_jump_da(addr):
+                self.__logger.error("Error on jumping to DA")
+                return -1
+            sync = self.usbread(1)
+            if sync != b"\xC0":
+                self.__logger.error("Error on DA sync")
+                return -1
+            nandinfo = unpack(">I", self.usbread(4))[0]
+            ids = unpack(">H", self.usbread(2))[0]
+            nandids = []
+            for i in range(0, ids):
+                tmp = unpack(">H", self.usbread(2))[0]
+                nandids.append(tmp)
+
+            emmcinfo = unpack(">I", self.usbread(4))[0]
+            emmcids = []
+            for i in range(0, 4):
+                tmp = unpack(">I", self.usbread(4))[0]
+                emmcids.append(tmp)
+
+            if nandids[0] != 0:
+                self.flash = "nand"
+            elif emmcids[0] != 0:
+                self.flash = "emmc"
+            else:
+                self.flash = "nor"
+
+            self.usbwrite(self.mtkcmd.ACK.value)
+            ackval = self.usbread(3)
+
+            self.usbwrite(self.mtkcmd.CMD_GET_VERSION.value)
+            self.usbwrite(pack("B", blver))
+
+            buffer = self.set_stage2_config(hwcode)
+            self.__logger.info("Uploading stage 2...")
+            # stage 2
+            flashinfo = self.brom_send(daconfig, blver + 2)
+            if flashinfo == -1:
+                self.__logger.error("Error on uploading stage 2")
+                return -1
+            if self.flash == "nand":
+                self.flashsize = flashinfo["m_nand_flash_size"]
+            elif self.flash == "emmc":
+                self.flashsize = flashinfo["m_emmc_ua_size"]
+                if self.flashsize == 0:
+                    self.flashsize = flashinfo["m_sdmmc_ua_size"]
+            elif self.flash == "nor":
+                self.flashsize = flashinfo["m_nor_flash_size"]
+            return flashinfo
 
     def initmtk(self):
         self.__logger.info("Status: Waiting for PreLoader VCOM, please connect mobile")
@@ -1261,15 +1704,16 @@ class Mtk(metaclass=LogBase):
         self.__logger.info("Disabling Watchdog...")
         self.SetReg_DisableWatchDogTimer(self.hwcode)  # D4
 
-        self.daconfig = None
-        for setup in self.da_setup:
-            if setup[0]["hw_code"] == self.hwcode:
-                if setup[0]["hw_version"] == self.hwver:
-                    if setup[0]["sw_version"] == self.swver:
-                        self.daconfig = setup
-                        break
-        if self.daconfig == None:
+        start = time.perf_counter()
+        self.daconfig, match = self.daloader.find(self.hwcode, self.hwver, self.swver)
+        elapsed = (time.perf_counter() - start) * 1000000
+        if self.daconfig is None:
             self.__logger.error("No da config set up")
+        else:
+            self.__logger.info("DA config:\t\t%s match in %.1f us" % (match, elapsed))
+            if match != "exact":
+                self.__logger.warning("No exact DA config for hw_version %s, sw_version %s, using %s match" %
+                                      (hex(self.hwver), hex(self.swver), match))
 
         '''
         #meid=self.da_get_meid()
@@ -1292,6 +1736,9 @@ class Mtk(metaclass=LogBase):
         '''
 
     def upload_da(self):
+        if self.daconfig is None:
+            self.__logger.error("No da config for hw code " + hex(self.hwcode) + ", can't upload da")
+            exit(1)
         self.blver = self.da_get_blver()
         self.__logger.info("Uploading da...")
         flashinfo = self.da_upload(self.hwcode, self.blver + 1, self.daconfig)
@@ -1340,10 +1787,12 @@ class Mtk(metaclass=LogBase):
         return False
 
     def writeflash(self, addr, length, filename, display=True):
+        # Anything written may touch the partition tables
+        self.gptcache.clear()
         return True
 
-    def readflash(self, addr, length, filename, display=True):
-        self.da_check_usb_cmd()
+    def readflash_cmd(self, addr, length):
+        # Sends the DA read command, returns the size of the packets the data comes in
         packetsize = 0x0
         if self.flash == "emmc":
             self.sdmmc_switch_part()
@@ -1378,64 +1827,271 @@ class Mtk(metaclass=LogBase):
             self.usbwrite(pack(">I", pagestoread))
             buffer = unpack(">I", self.usbread(4))[0]
             self.readsize = self.flashsize // self.pagesize * (self.pagesize + self.sparesize)
+        return packetsize
+
+    def readflash(self, addr, length, filename, display=True, sink=None):
         if display:
             print_progress(0, 100, prefix='Progress:', suffix='Complete', bar_length=50)
-        old = 0
-
-        if filename != "":
-            with open(filename, "wb") as wf:
-                bytestoread = length
-                while (bytestoread > 0):
-                    size = bytestoread
-                    if bytestoread > packetsize:
-                        size = packetsize
-                    for i in range(0, size, 0x400):
-                        data = self.usbread(0x400)
-                        bytestoread -= len(data)
-                        wf.write(data)
-                    checksum = unpack(">H", self.usbread(2))[0]
-                    self.usbwrite(self.mtkdacmd.ACK.value)
-                    if display:
-                        prog = (length - bytestoread) / length * 100
-                        if int(prog) > old:
-                            print_progress(prog, 100, prefix='Progress:', suffix='Complete', bar_length=50)
-                            old = prog
-                return True
+
+        # A short read returns False, also for buffer reads
+        if sink is not None:
+            return self.readflash_sink(addr, length, sink, display) == length
+        elif filename != "":
+            with self.filesink(filename, length) as wf:
+                return self.readflash_sink(addr, length, wf, display) == length
         else:
-            buffer = b""
-            bytestoread = length
-            while (bytestoread > 0):
-                size = bytestoread
-                if bytestoread > packetsize:
-                    size = packetsize
-                for i in range(0, size, 0x400):
-                    data = self.usbread(0x400)
-                    bytestoread -= len(data)
-                    buffer += data
-                checksum = unpack(">H", self.usbread(2))[0]
-                self.usbwrite(self.mtkdacmd.ACK.value)
-                if display:
-                    prog = (length - bytestoread) / length * 100
-                    if int(prog) > old:
-                        print_progress(prog, 100, prefix='Progress:', suffix='Complete', bar_length=50)
-                        old = prog
-            return buffer
+            buffer = buffer_sink(length)
+            if self.readflash_sink(addr, length, buffer, display) < length:
+                return False
+            return buffer.getvalue()
+
+    def readflash_sink(self, addr, length, sink, display=True):
+        # A sink that can't patch is fed by DA reads of at most streamreadsize, so refetching
+        # a bad packet only drains the rest of one of them
+        chunk = length if hasattr(sink, "patch") else self.streamreadsize
+        pos = 0
+        while pos < length:
+            size = min(chunk, length - pos)
+            self.da_check_usb_cmd()
+            packetsize = self.readflash_cmd(addr + pos, size)
+            received = self.readflash_stream(addr + pos, size, packetsize, sink, display, pos, length)
+            pos += received
+            if received < size:
+                break
+        return pos
+
+    def filesink(self, filename, length):
+        # Output file for a dump of length bytes, honours --sparse and --compress
+        if self.compress is not None:
+            extension = compress_sink.extensions[self.compress]
+            if not filename.endswith(extension):
+                filename += extension
+            if self.compresspool is None:
+                self.compresspool = ThreadPoolExecutor(os.cpu_count() or 1)
+            return compress_sink(filename, self.compress, pool=self.compresspool)
+        elif self.sparse == "android":
+            return android_sparse_sink(filename, 4096 if length % 4096 == 0 else 512)
+        elif self.sparse == "holes":
+            return hole_sink(filename)
+        return file_sink(filename)
+
+    def readpartitions(self, partitions, directory, maxgap=0x100000):
+        # Partitions less than maxgap apart share one DA read, split and hashed on a writer thread; returns manifest entries
+        groups = []
+        for partition in sorted(partitions, key=lambda entry: entry.sector):
+            start = partition.sector * self.pagesize
+            end = start + partition.sectors * self.pagesize
+            if len(groups) > 0 and groups[-1][1] <= start <= groups[-1][1] + maxgap:
+                groups[-1][1] = end
+                groups[-1][2].append(partition)
+            else:
+                groups.append([start, end, [partition]])
+        entries = []
+        failed = False
+        for start, end, members in groups:
+            if failed:
+                # The DA stopped answering, don't wait for it once per partition
+                for partition in members:
+                    entries.append({"name": partition.name, "sector": partition.sector, "sectors": partition.sectors,
+                                    "error": "not read"})
+                continue
+            parts = []
+            for partition in members:
+                filename = os.path.join(directory, partition.name + ".bin")
+                self.__logger.info(
+                    f"Dumping partition {str(partition.name)} with sector count {str(partition.sectors)} as {filename}.")
+                parts.append((partition.sector * self.pagesize - start, partition.sectors * self.pagesize,
+                              hash_sink(self.filesink(filename, partition.sectors * self.pagesize), self.hashes)))
+            with threaded_sink(split_sink(parts)) as sink:
+                if end > start and not self.readflash(start, end - start, "", sink=sink):
+                    failed = True
+            for partition, (offset, length, sink) in zip(members, parts):
+                entry = {"name": partition.name, "sector": partition.sector, "sectors": partition.sectors,
+                         "file": os.path.basename(sink.filename)}
+                if sink.length < length:
+                    self.__logger.error(f"Dump of {partition.name} is incomplete, got {hex(sink.length)} "
+                                        f"of {hex(length)} bytes.")
+                    entry["error"] = f"short read, {sink.length} of {length} bytes"
+                else:
+                    entry.update(sink.hexdigests())
+                entries.append(entry)
+        return entries
+
+    def readflash_resume(self, addr, length, filename, resume=False, blocksize=0x1000000):
+        # Reads to filename, recording the sha256 of each finished block so --resume only reads what's missing
+        manifestname = filename + ".manifest.json"
+        journalname = filename + ".manifest.journal"
+        manifest = {"offset": addr, "length": length, "blocksize": blocksize, "blocks": []}
+        if resume and os.path.exists(manifestname) and os.path.exists(filename):
+            with open(manifestname, "r") as rf:
+                oldmanifest = json.load(rf)
+            if [oldmanifest["offset"], oldmanifest["length"], oldmanifest["blocksize"]] == [addr, length, blocksize]:
+                # Blocks finished by a run that didn't get to compact its journal
+                if os.path.exists(journalname):
+                    with open(journalname, "r") as rf:
+                        for line in rf:
+                            try:
+                                oldmanifest["blocks"].append(json.loads(line))
+                            except ValueError:
+                                break
+                blocks = {block["offset"]: block for block in oldmanifest["blocks"]}
+                with open(filename, "rb") as rf:
+                    for block in blocks.values():
+                        rf.seek(block["offset"])
+                        if hashlib.sha256(rf.read(block["length"])).hexdigest() == block["sha256"]:
+                            manifest["blocks"].append(block)
+                self.__logger.info(f"Resuming, {len(manifest['blocks'])} of {len(blocks)} "
+                                   f"recorded blocks are intact.")
+            else:
+                self.__logger.warning("Manifest was written for a different range, starting over.")
+
+        def save():
+            with open(manifestname + ".tmp", "w") as wf:
+                json.dump(manifest, wf)
+            os.replace(manifestname + ".tmp", manifestname)
+
+        done = set(block["offset"] for block in manifest["blocks"])
+        extents = []
+        for offset in range(0, length, blocksize):
+            if offset in done:
+                continue
+            size = min(blocksize, length - offset)
+            if len(extents) > 0 and extents[-1][0] + extents[-1][1] == offset:
+                extents[-1][1] += size
+            else:
+                extents.append([offset, size])
+        with open(filename, "r+b" if len(done) > 0 else "w+b") as wf:
+            save()
+            # Finished blocks are appended to the journal, the manifest is only rewritten once at the end
+            journal = open(journalname, "w")
+
+            blocks = {block["offset"]: block for block in manifest["blocks"]}
+
+            def completed(offset, size, digest):
+                # A refetched packet reports its block again, the later entry wins
+                block = {"offset": offset, "length": size, "sha256": digest}
+                if offset in blocks:
+                    blocks[offset].update(block)
+                else:
+                    blocks[offset] = block
+                    manifest["blocks"].append(block)
+                journal.write(json.dumps(block) + "\n")
+                journal.flush()
+
+            try:
+                for offset, size in extents:
+                    with block_sink(wf, offset, size, blocksize, completed) as sink:
+                        if not self.readflash(addr + offset, size, "", sink=sink):
+                            break
+            finally:
+                journal.close()
+                save()
+                os.remove(journalname)
+        return sum(block["length"] for block in manifest["blocks"]) == length
+
+    def readflash_stream(self, addr, length, packetsize, sink, display=True, done=0, total=None):
+        # One packet buffer is reused for the whole transfer, the sink gets slices of it
+        packet = array.array('B', bytes(min(packetsize, length)))
+        view = memoryview(packet)
+        patch = getattr(sink, "patch", None)
+        badpackets = []
+        # done and total place this read within a larger one for the progress bar and patches
+        if total is None:
+            total = length
+        old = int(done / total * 100)
+        pos = 0
+        while pos < length:
+            size = min(length - pos, packetsize)
+            if size > len(packet):
+                packet = array.array('B', bytes(size))
+                view = memoryview(packet)
+            # The whole DA packet is fetched with a single bulk read
+            if size == len(packet):
+                received = self.usbreadinto(packet)
+            else:
+                received = self.usbreadinto(view[:size])
+            checksum = self.usbread(2)
+            self.usbwrite(self.mtkdacmd.ACK.value)
+            if received < size or len(checksum) < 2:
+                sink.write(view[:received])
+                pos += received
+                self.__logger.error("Short read at offset " + hex(pos))
+                break
+            checksum = unpack(">H", checksum)[0]
+            if self.verify_checksum and checksum16(view[:size]) != checksum:
+                if patch is not None:
+                    # Kept for now, the sink gets the refetched packet once this read is done
+                    badpackets.append((pos, bytes(view[:size])))
+                    sink.write(view[:size])
+                else:
+                    # A stream can't be patched: finish this read, refetch the packet, go on behind it
+                    data = bytes(view[:size])
+                    self.readflash_drain(length - pos - size, packetsize)
+                    sink.write(self.readflash_packet(addr + pos, data))
+                    if pos + size < length:
+                        self.da_check_usb_cmd()
+                        packetsize = self.readflash_cmd(addr + pos + size, length - pos - size)
+            else:
+                sink.write(view[:size])
+            pos += size
+            if display:
+                prog = (done + pos) / total * 100
+                if int(prog) > old:
+                    print_progress(prog, 100, prefix='Progress:', suffix='Complete', bar_length=50)
+                    old = prog
+        for offset, data in badpackets:
+            patch(done + offset, self.readflash_packet(addr + offset, data))
+        return pos
+
+    def readflash_drain(self, length, packetsize):
+        # Reads and acknowledges the rest of a read whose data isn't needed anymore
+        scratch = array.array('B', bytes(min(packetsize, length)))
+        view = memoryview(scratch)
+        while length > 0:
+            size = min(length, packetsize, len(scratch))
+            received = self.usbreadinto(view[:size])
+            self.usbread(2)
+            self.usbwrite(self.mtkdacmd.ACK.value)
+            if received < size:
+                break
+            length -= size
+
+    def readflash_packet(self, addr, data):
+        # Refetches a bad packet; identical data twice means the checksum is off, so verification is turned off
+        size = len(data)
+        for retry in range(self.readretries):
+            self.da_check_usb_cmd()
+            self.readflash_cmd(addr, size)
+            packet = array.array('B', bytes(size))
+            received = self.usbreadinto(packet)
+            checksum = self.usbread(2)
+            self.usbwrite(self.mtkdacmd.ACK.value)
+            if received < size or len(checksum) < 2:
+                continue
+            checksum = unpack(">H", checksum)[0]
+            if checksum16(packet) == checksum:
+                return packet.tobytes()
+            if packet.tobytes() == data:
+                self.__logger.warning(f"Packet at {hex(addr)} reads back identical with a wrong checksum, "
+                                      "disabling checksum verification.")
+                self.verify_checksum = False
+                return data
+            data = packet.tobytes()
+        self.__logger.error(f"Packet at {hex(addr)} still fails its checksum after {self.readretries} retries.")
+        return data
 
 
 class Main(metaclass=LogBase):
     def detect_partition(self, mtk, arguments, partitionname):
-        fpartitions = []
-        data, guid_gpt = mtk.get_gpt(int(arguments["--gpt-num-part-entries"]),
-                                     int(arguments["--gpt-part-entry-size"]),
-                                     int(arguments["--gpt-part-entry-start-lba"]))
+        gptargs = (int(arguments["--gpt-num-part-entries"]), int(arguments["--gpt-part-entry-size"]),
+                   int(arguments["--gpt-part-entry-start-lba"]))
+        partition = mtk.get_partition(partitionname, *gptargs)
+        if partition is not None:
+            return [True, partition]
+        data, guid_gpt = mtk.get_gpt(*gptargs)
         if guid_gpt is None:
-            return [False, fpartitions]
-        else:
-            for partition in guid_gpt.partentries:
-                fpartitions.append(partition)
-                if partition.name == partitionname:
-                    return [True, partition]
-        return [False, fpartitions]
+            return [False, []]
+        return [False, list(guid_gpt.partentries)]
 
     def detectusbdevices(self):
         dev = usb.core.find(find_all=True)
@@ -1456,16 +2112,20 @@ class Main(metaclass=LogBase):
             self.__logger.setLevel(logging.INFO)
         interface = -1
         pagesize = int(args["--sectorsize"], 16)
+        # One capture for every connection, closed at exit
+        trace = None
+        if args["--usbtrace"] is not None:
+            trace = usb_trace(args["--usbtrace"])
 
         if args["dumpbrom"]:
             if vid != 0xE8D and pid != 0x0003:
                 mtk = Mtk(loader=args["--loader"], loglevel=self.__logger.level, vid=vid, pid=pid, interface=interface,
-                          pagesize=pagesize, args=args)
+                          pagesize=pagesize, args=args, trace=trace)
                 mtk.initmtk()
                 self.__logger.info("Crashing da... (entering bootrom)")
                 mtk.da_send(0, 0x100, 0x100, b'\x00' * 0x100)
             preloader = Mtk(loader=args["--loader"], loglevel=self.__logger.level, vid=0xE8D, pid=0x0003, interface=1,
-                            pagesize=pagesize, args=args)
+                            pagesize=pagesize, args=args, trace=trace)
             preloader.initmtk()
             filename=args["--filename"]
             if filename==None:
@@ -1483,14 +2143,14 @@ class Main(metaclass=LogBase):
             sys.exit(0)
         elif args["crash"]:
             mtk = Mtk(loader=args["--loader"], loglevel=self.__logger.level, vid=vid, pid=pid, interface=interface,
-                      pagesize=pagesize, args=args)
+                      pagesize=pagesize, args=args, trace=trace)
             mtk.initmtk()
             self.__logger.info("Crashing da...")
             mtk.da_send(0, 0x100, 0x100, b'\x00' * 0x100)
             sys.exit(0)
         elif args["payload"]:
             mtk = Mtk(loader=args["--loader"], loglevel=self.__logger.level, vid=vid, pid=pid, interface=interface,
-                      pagesize=pagesize, args=args)
+                      pagesize=pagesize, args=args, trace=trace)
             mtk.initmtk()
             payloadfile = args["--payload"]
             if payloadfile == "":
@@ -1504,14 +2164,14 @@ class Main(metaclass=LogBase):
             sys.exit(0)
         elif args["gettargetconfig"]:
             mtk = Mtk(loader=args["--loader"], loglevel=self.__logger.level, vid=vid, pid=pid, interface=interface,
-                      pagesize=pagesize,args=args)
+                      pagesize=pagesize, args=args, trace=trace)
             mtk.initmtk()
             self.__logger.info("Getting target info...")
             mtk.cmd_get_target_config()
             sys.exit(0)
         else:
             mtk = Mtk(loader=args["--loader"], loglevel=self.__logger.level, vid=vid, pid=pid, interface=interface,
-                      pagesize=pagesize,args=args)
+                      pagesize=pagesize, args=args, trace=trace)
             mtk.initmtk()
             mtk.upload_da()
 
@@ -1520,7 +2180,6 @@ class Main(metaclass=LogBase):
             if directory is None:
                 directory = ""
 
-            sfilename = os.path.join(directory, f"gpt_main.bin")
             data, guid_gpt = mtk.get_gpt(int(args["--gpt-num-part-entries"]),
                                          int(args["--gpt-part-entry-size"]),
                                          int(args["--gpt-part-entry-start-lba"]))
@@ -1529,14 +2188,11 @@ class Main(metaclass=LogBase):
                 mtk.da_finish(0x0)
                 exit(1)
             else:
-                with open(sfilename, "wb") as wf:
-                    wf.write(data)
-
-                print(f"Dumped GPT from to {sfilename}")
-                sfilename = os.path.join(directory, f"gpt_backup.bin")
-                with open(sfilename, "wb") as wf:
-                    wf.write(data[mtk.pagesize:])
-                print(f"Dumped Backup GPT to {sfilename}")
+                for name, gptdata in mtk.gptfiles(data, guid_gpt, mtk.pagesize):
+                    sfilename = os.path.join(directory, name)
+                    with open(sfilename, "wb") as wf:
+                        wf.write(gptdata)
+                    print(f"Dumped {'Backup GPT' if name == 'gpt_backup.bin' else 'GPT'} to {sfilename}")
             mtk.da_finish(0x0)  # DISCONNECT_USB_AND_RELEASE_POWERKEY
             exit(0)
         elif args["printgpt"]:
@@ -1563,12 +2219,15 @@ class Main(metaclass=LogBase):
             for partition in partitions:
                 partfilename = filenames[i]
                 i += 1
-                res = detect_partition(mtk, args, partition)
+                res = self.detect_partition(mtk, args, partition)
                 if res[0] == True:
                     rpartition = res[1]
-                    mtk.readflash(rpartition.sector * mtk.pagesize, rpartition.sectors * mtk.pagesize, partfilename)
-                    print(
-                        f"Dumped sector {str(rpartition.sector)} with sector count {str(rpartition.sectors)} as {partfilename}.")
+                    if mtk.readflash(rpartition.sector * mtk.pagesize, rpartition.sectors * mtk.pagesize,
+                                     partfilename):
+                        print(f"Dumped sector {str(rpartition.sector)} with sector count {str(rpartition.sectors)} "
+                              f"as {partfilename}.")
+                    else:
+                        self.__logger.error(f"Dump of {partfilename} is incomplete.")
                 else:
                     self.__logger.error(f"Error: Couldn't detect partition: {partition}\nAvailable partitions:")
                     for rpartition in res[1]:
@@ -1594,22 +2253,26 @@ class Main(metaclass=LogBase):
                 storedir = directory
                 if not os.path.exists(storedir):
                     os.mkdir(storedir)
-                sfilename = os.path.join(storedir, f"gpt_main.bin")
-                with open(sfilename, "wb") as wf:
-                    wf.write(data)
-
-                sfilename = os.path.join(storedir, f"gpt_backup.bin")
-                with open(sfilename, "wb") as wf:
-                    wf.write(data[mtk.pagesize * 2:])
-
-                for partition in guid_gpt.partentries:
-                    partitionname = partition.name
-                    if partition.name in skip:
-                        continue
-                    filename = os.path.join(storedir, partitionname + ".bin")
-                    logging.info(
-                        f"Dumping partition {str(partition.name)} with sector count {str(partition.sectors)} as {filename}.")
-                    mtk.readflash(partition.sector * mtk.pagesize, partition.sectors * mtk.pagesize, filename)
+                gptfiles = []
+                for name, gptdata in mtk.gptfiles(data, guid_gpt, mtk.pagesize * 2):
+                    with open(os.path.join(storedir, name), "wb") as wf:
+                        wf.write(gptdata)
+                    gptfiles.append({"file": name, "data": gptdata})
+
+                partitions = [partition for partition in guid_gpt.partentries if partition.name not in skip]
+                entries = mtk.readpartitions(partitions, storedir)
+                # Hashes are over the raw flash data, also for --sparse and --compress output
+                for entry in gptfiles:
+                    gptdata = entry.pop("data")
+                    for algorithm in mtk.hashes:
+                        entry[algorithm] = hashlib.new(algorithm, gptdata).hexdigest()
+                with open(os.path.join(storedir, "manifest.json"), "w") as wf:
+                    json.dump({"pagesize": mtk.pagesize, "gpt": gptfiles, "partitions": entries}, wf, indent=4)
+                failed = [entry["name"] for entry in entries if "error" in entry]
+                if len(failed) > 0:
+                    self.__logger.error("Failed to dump: " + ", ".join(failed))
+                    mtk.da_finish(0x0)
+                    exit(1)
             mtk.da_finish(0x0)  # DISCONNECT_USB_AND_RELEASE_POWERKEY
             exit(0)
         elif args["rf"]:
@@ -1623,16 +2286,26 @@ class Main(metaclass=LogBase):
             else:
                 sfilename = filename
                 print(f"Dumping sector 0 with flash size {hex(mtk.flashsize)} as {filename}.")
-                mtk.readflash(0, mtk.flashsize, sfilename)
-                print(f"Dumped sector 0 with flash size {hex(mtk.flashsize)} as {filename}.")
+                if mtk.compress is not None:
+                    # A compressed stream has no fixed block offsets to resume at
+                    if mtk.readflash(0, mtk.flashsize, sfilename):
+                        print(f"Dumped sector 0 with flash size {hex(mtk.flashsize)} as {filename}.")
+                    else:
+                        self.__logger.error(f"Dump of {filename} is incomplete.")
+                elif mtk.readflash_resume(0, mtk.flashsize, sfilename, args["--resume"]):
+                    print(f"Dumped sector 0 with flash size {hex(mtk.flashsize)} as {filename}.")
+                else:
+                    self.__logger.error(f"Dump of {filename} is incomplete, run again with --resume to continue.")
             mtk.da_finish(0x0)  # DISCONNECT_USB_AND_RELEASE_POWERKEY
             exit(0)
         elif args["rs"]:
             start = int(args["<start_sector>"])
             sectors = int(args["<sectors>"])
             filename = args["<filename>"]
-            mtk.readflash(0, start * mtk.pagesize, sectors * mtk.pagesize, filename)
-            print(f"Dumped sector {str(start)} with sector count {str(sectors)} as {filename}.")
+            if mtk.readflash_resume(start * mtk.pagesize, sectors * mtk.pagesize, filename, args["--resume"]):
+                print(f"Dumped sector {str(start)} with sector count {str(sectors)} as {filename}.")
+            else:
+                self.__logger.error(f"Dump of {filename} is incomplete, run again with --resume to continue.")
             mtk.da_finish(0x0)  # DISCONNECT_USB_AND_RELEASE_POWERKEY
             exit(0)
         elif args["footer"]:
@@ -1653,7 +2326,7 @@ class Main(metaclass=LogBase):
                                                  "", False)
                         else:
                             data = mtk.readflash(partition.sector * mtk.pagesize, 0x4000, "", False)
-                        if data == b"":
+                        if not data:
                             continue
                         val = struct.unpack("<I", data[:4])[0]
                         if (val & 0xFFFFFFF0) == 0xD0B5B1C0:
@@ -1941,12 +2614,7 @@ class UsbDl:
         if status > 0xff:
             raise ProtocolError(status)
 
-        calc_checksum = 0
-        padded_data = data
-        if len(padded_data) % 2 != 0:
-            padded_data += b'\0'
-        for i in range(0, len(padded_data), 2):
-            calc_checksum ^= struct.unpack_from('<H', padded_data, i)[0]
+        calc_checksum = xor16(data)
 
         start_time = time.time()
         self._send_bytes(data, echo=False)
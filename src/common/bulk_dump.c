@@ -0,0 +1,48 @@
+#include <stdint.h>
+
+#define _STRINGIFY(str) #str
+#define STRINGIFY(str) _STRINGIFY(str)
+
+#ifdef DEVICE_HEADER
+#include STRINGIFY(DEVICE_HEADER)
+#endif
+
+#ifndef BROM_BASE
+#define BROM_BASE 0x0
+#endif
+
+#define BROM_SIZE 0x20000
+#define CHUNK_SIZE 0x1000
+
+// Read at runtime, a constant null base would let the compiler drop the loads
+volatile uint32_t brom_base = BROM_BASE;
+volatile uint32_t *wdt = (volatile uint32_t *)0x10007000;
+
+__attribute__ ((section(".text.main"))) int main() {
+    //This is so we don't get a USB-Timeout
+    send_usb_response(1,0,1);
+
+    uint32_t magic=0xB1B2B3B4;
+    usbdl_put_data(&magic,4);
+
+    // Each chunk is sent as is, followed by the 32-bit sum of its words
+    for (uint32_t offset = 0; offset < BROM_SIZE; offset += CHUNK_SIZE) {
+        volatile uint32_t *chunk = (volatile uint32_t *)(brom_base + offset);
+        uint32_t sum = 0;
+        for (uint32_t i = 0; i < CHUNK_SIZE / 4; i++) {
+            sum += chunk[i];
+        }
+        usbdl_put_data((void *)chunk, CHUNK_SIZE);
+        usbdl_put_data(&sum, 4);
+    }
+
+    // Reboot device, so we still get feedback in case the above didn't work
+    wdt[8/4] = 0x1971;
+    wdt[0/4] = 0x22000014;
+    wdt[0x14/4] = 0x1209;
+
+    while (1) {
+
+    }
+
+}
@@ -0,0 +1,44 @@
+import os
+import sys
+from struct import unpack
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from Library.sinks import android_sparse_sink  # noqa: E402
+
+
+class small_chunk_sparse_sink(android_sparse_sink):
+    MAX_CHUNK_SIZE = android_sparse_sink.CHUNK_HEADER_SIZE + 3 * 512
+
+
+def read_sparse(filename):
+    with open(filename, "rb") as rf:
+        data = rf.read()
+    magic, _, _, _, _, blocksize, totalblocks, totalchunks, _ = unpack("<IHHHHIIII", data[:28])
+    assert magic == android_sparse_sink.SPARSE_HEADER_MAGIC
+    chunks = []
+    image = bytearray()
+    pos = 28
+    while pos < len(data):
+        chunktype, _, blocks, size = unpack("<HHII", data[pos:pos + 12])
+        if chunktype == android_sparse_sink.CHUNK_TYPE_RAW:
+            assert size == 12 + blocks * blocksize
+            image += data[pos + 12:pos + size]
+        else:
+            image += data[pos + 12:pos + 16] * (blocks * blocksize // 4)
+        chunks.append((chunktype, blocks))
+        pos += size
+    assert len(chunks) == totalchunks
+    assert len(image) == totalblocks * blocksize
+    return bytes(image), chunks
+
+
+def test_raw_run_is_split_at_chunk_size(tmp_path):
+    filename = str(tmp_path / "image.sparse")
+    image = os.urandom(8 * 512) + bytes(4 * 512) + os.urandom(2 * 512)
+    sink = small_chunk_sparse_sink(filename, 512)
+    sink.write(memoryview(image)[:1000])
+    sink.write(memoryview(image)[1000:])
+    sink.close()
+    data, chunks = read_sparse(filename)
+    assert data == image
+    assert chunks == [(0xCAC1, 3), (0xCAC1, 3), (0xCAC1, 2), (0xCAC2, 3), (0xCAC2, 1), (0xCAC1, 2)]